@@ -0,0 +1,310 @@
+import gzip
+import hashlib
+import json
+import pathlib
+import pickle
+
+from debian import deb822
+from debian.debian_support import version_compare
+
+import mirror
+
+INDEX_CACHE_DIR = pathlib.Path("~/.cache/demar/index").expanduser()
+
+MIRROR = "/srv/debian-mirror/mirror"
+DIST = "sid"
+COMPONENTS = ["main", "contrib", "non-free", "non-free-firmware"]
+
+PACKAGES_FIELDS = ["Package", "Version", "Depends", "Pre-Depends", "Provides"]
+SOURCES_FIELDS = ["Package", "Version", "Build-Depends", "Build-Depends-Arch", "Build-Depends-Indep"]
+
+# debootstrap's default variant installs these priorities, Essential packages
+# and their dependencies
+DEBOOTSTRAP_FIELDS = PACKAGES_FIELDS + ["Source", "Priority", "Essential"]
+DEBOOTSTRAP_PRIORITIES = ["required", "important"]
+
+# massrebuild counts the builds of a source exceeding its time or memory caps,
+# from this many on the source is skipped
+RESOURCE_FAIL_LIMIT = 2
+
+VERSION_RELATIONS = {
+    "<<": lambda c: c < 0,
+    "<=": lambda c: c <= 0,
+    "=": lambda c: c == 0,
+    ">=": lambda c: c >= 0,
+    ">>": lambda c: c > 0,
+}
+
+
+def packages_file(component: str, arch: str) -> pathlib.Path:
+    return pathlib.Path(f"{MIRROR}/dists/{DIST}/{component}/binary-{arch}/Packages.gz")
+
+
+def sources_file(component: str) -> pathlib.Path:
+    return pathlib.Path(f"{MIRROR}/dists/{DIST}/{component}/source/Sources.gz")
+
+
+def contents_file(component: str, arch: str) -> pathlib.Path:
+    return pathlib.Path(f"{MIRROR}/dists/{DIST}/{component}/Contents-{arch}.gz")
+
+
+def binary_packages_files(arch: str) -> list[pathlib.Path]:
+    return [packages_file(component, pkglist_arch) for component in COMPONENTS for pkglist_arch in (arch, "all")]
+
+
+def iter_contents(contents: pathlib.Path):
+    with gzip.open(contents, "rt") as fp:
+        for line in fp:
+            path, packages = line.rstrip("\n").rsplit(maxsplit=1)
+            yield path, [package.rsplit("/", 1)[1] for package in packages.split(",")]
+
+
+def index_cache_file(files: list[pathlib.Path], name: str, params: list) -> pathlib.Path | None:
+    # keyed by the hashes mirror.py recorded, so a cache hit costs one stat per file
+    hash_cache = mirror.read_hash_cache()
+    hashes = [mirror.cached_hash(file, hash_cache) for file in files]
+    if None in hashes:
+        return None
+    # the file list is part of the kind, so e.g. each arch keeps its own cache
+    kind = hashlib.sha256(json.dumps([name, params, [str(file) for file in files]]).encode()).hexdigest()[0:8]
+    key = hashlib.sha256(json.dumps(hashes).encode()).hexdigest()[0:16]
+    return INDEX_CACHE_DIR / f"{name}-{kind}-{key}.pickle"
+
+
+def read_index_cache(cache_file: pathlib.Path | None):
+    if cache_file is None or not cache_file.exists():
+        return None
+    with cache_file.open("rb") as fp:
+        return pickle.load(fp)
+
+
+def write_index_cache(cache_file: pathlib.Path, data):
+    INDEX_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    prefix = cache_file.name.rsplit("-", 1)[0]
+    for old_file in INDEX_CACHE_DIR.glob(f"{prefix}-*.pickle"):
+        old_file.unlink(missing_ok=True)
+    new_file = cache_file.with_name(f"{cache_file.name}.new")
+    with new_file.open("wb") as fp:
+        pickle.dump(data, fp, protocol=pickle.HIGHEST_PROTOCOL)
+    new_file.replace(cache_file)
+
+
+def read_latest_paragraphs(files: list[pathlib.Path], cls, fields: list[str]) -> dict[str, dict[str, str]]:
+    cache_file = index_cache_file(files, cls.__name__, fields)
+    if (paragraphs := read_index_cache(cache_file)) is not None:
+        return paragraphs
+
+    paragraphs = {}
+    for file in files:
+        with gzip.open(file, "rt") as fp:
+            for para in cls.iter_paragraphs(fp, fields=fields):
+                name = para["Package"]
+                other = paragraphs.get(name)
+                if other and version_compare(other["Version"], para["Version"]) >= 0:
+                    continue
+                paragraphs[name] = dict(para)
+
+    if cache_file is not None:
+        write_index_cache(cache_file, paragraphs)
+    return paragraphs
+
+
+def read_binary_sources(arch: str) -> dict[str, str]:
+    bin_sources = {}
+    for component in COMPONENTS:
+        for pkglist_arch in (arch, "all"):
+            with gzip.open(packages_file(component, pkglist_arch), "rt") as pkglist:
+                for pkg in deb822.Packages.iter_paragraphs(pkglist, fields=["Package", "Source"]):
+                    bin_sources[pkg["Package"]] = pkg.source
+    return bin_sources
+
+
+def get_debootstrap_sources(arch: str) -> set[str]:
+    files = binary_packages_files(arch)
+    cache_file = index_cache_file(files, "debootstrap-sources", [arch, DEBOOTSTRAP_FIELDS, DEBOOTSTRAP_PRIORITIES])
+    if (sources := read_index_cache(cache_file)) is not None:
+        return sources
+
+    index = BinaryIndex(arch, DEBOOTSTRAP_FIELDS)
+    base = sorted(
+        name
+        for name, para in index.packages.items()
+        if para.get("Essential") == "yes" or para.get("Priority") in DEBOOTSTRAP_PRIORITIES
+    )
+    installed, _ = index.closure(deb822.PkgRelation.parse_relations(", ".join(base)))
+    sources = {index.packages[name].get("Source", name).split(" ")[0] for name in installed}
+
+    if cache_file is not None:
+        write_index_cache(cache_file, sources)
+    return sources
+
+
+def read_sources() -> dict[str, dict[str, str]]:
+    return read_latest_paragraphs([sources_file(c) for c in COMPONENTS], deb822.Sources, SOURCES_FIELDS)
+
+
+def read_installed_build_depends(buildinfo_file: pathlib.Path) -> dict[str, str]:
+    with buildinfo_file.open("r") as fp:
+        buildinfo = deb822.BuildInfo(fp)
+
+    installed = {}
+    for rel in buildinfo.relations["installed-build-depends"]:
+        dep = rel[0]
+        if dep.get("version"):
+            installed[dep["name"]] = dep["version"][1]
+    return installed
+
+
+def changed_build_depends(installed: dict[str, str], current_versions: dict[str, str]) -> list[str]:
+    # build-deps which vanished from the archive count as changed too
+    return sorted(name for name, version in installed.items() if current_versions.get(name) != version)
+
+
+def read_fail_file(file: pathlib.Path) -> dict[str, tuple[int, str]]:
+    # "<count> <source> <reason>" per line
+    if not file.exists():
+        return {}
+    with file.open("r") as fp:
+        fails = [line.split(" ", maxsplit=2) for line in fp.read().strip().splitlines()]
+    return {fail[1]: (int(fail[0]), fail[2]) for fail in fails}
+
+
+def fail_skip_reasons(fails: dict[str, tuple[int, str]]) -> dict[str, str]:
+    return {
+        srcpkg_name: f"exceeded build limits {count} times, last: {reason}"
+        for srcpkg_name, (count, reason) in fails.items()
+        if count >= RESOURCE_FAIL_LIMIT
+    }
+
+
+def arch_matches(spec: str, arch: str) -> bool:
+    return spec in (arch, "any", "linux-any", f"any-{arch}", f"linux-{arch}")
+
+
+def relation_applies(dep: dict, arch: str, profiles: frozenset[str]) -> bool:
+    if dep.get("arch"):
+        enabled = [a for a in dep["arch"] if a.enabled]
+        if enabled:
+            if not any(arch_matches(a.arch, arch) for a in enabled):
+                return False
+        elif any(arch_matches(a.arch, arch) for a in dep["arch"]):
+            return False
+
+    if dep.get("restrictions"):
+        # restriction formulas are a disjunction of conjunctions
+        return any(all((term.profile in profiles) == term.enabled for term in group) for group in dep["restrictions"])
+
+    return True
+
+
+def filter_relations(relations: list[list[dict]], arch: str, profiles: frozenset[str]) -> list[list[dict]]:
+    filtered = []
+    for alternatives in relations:
+        alternatives = [dep for dep in alternatives if relation_applies(dep, arch, profiles)]
+        if alternatives:
+            filtered.append(alternatives)
+    return filtered
+
+
+def get_build_depends(source: dict[str, str], arch: str, profiles: frozenset[str] = frozenset()) -> list[list[dict]]:
+    relations = []
+    for field in ("Build-Depends", "Build-Depends-Arch", "Build-Depends-Indep"):
+        if source.get(field):
+            relations.extend(deb822.PkgRelation.parse_relations(source[field]))
+    return filter_relations(relations, arch, profiles)
+
+
+class BinaryIndex:
+    def __init__(self, arch: str, fields: list[str] = PACKAGES_FIELDS):
+        self.arch = arch
+        self.packages = read_latest_paragraphs(binary_packages_files(arch), deb822.Packages, fields)
+        self.versions = {name: para["Version"] for name, para in self.packages.items()}
+
+        self.providers: dict[str, list[tuple[str, str | None]]] = {}
+        for name, para in self.packages.items():
+            if not para.get("Provides"):
+                continue
+            for rel in deb822.PkgRelation.parse_relations(para["Provides"]):
+                provided = rel[0]
+                version = provided["version"][1] if provided.get("version") else None
+                self.providers.setdefault(provided["name"], []).append((name, version))
+
+        self._depends_cache: dict[str, list[list[dict]]] = {}
+        self._broken: set[str] | None = None
+
+    def candidates(self, dep: dict) -> list[str]:
+        found = []
+        if dep["name"] in self.versions and self.version_satisfies(self.versions[dep["name"]], dep.get("version")):
+            found.append(dep["name"])
+        for provider, version in self.providers.get(dep["name"], []):
+            # unversioned provides never satisfy versioned dependencies
+            if dep.get("version") is None or (version and self.version_satisfies(version, dep["version"])):
+                found.append(provider)
+        return found
+
+    @staticmethod
+    def version_satisfies(version: str, constraint: tuple[str, str] | None) -> bool:
+        if constraint is None:
+            return True
+        op, wanted = constraint
+        return VERSION_RELATIONS[op](version_compare(version, wanted))
+
+    def depends(self, name: str) -> list[list[dict]]:
+        if name not in self._depends_cache:
+            para = self.packages[name]
+            relations = []
+            for field in ("Pre-Depends", "Depends"):
+                if para.get(field):
+                    relations.extend(deb822.PkgRelation.parse_relations(para[field]))
+            self._depends_cache[name] = filter_relations(relations, self.arch, frozenset())
+        return self._depends_cache[name]
+
+    def satisfiable(self, name: str, broken: set[str]) -> bool:
+        return all(
+            any(found not in broken for dep in alternatives for found in self.candidates(dep))
+            for alternatives in self.depends(name)
+        )
+
+    def broken(self) -> set[str]:
+        # packages with a dependency none of whose candidates is installable,
+        # spread from the missing ones to their reverse dependencies
+        if self._broken is None:
+            rdepends = {}
+            todo = []
+            for name in self.packages:
+                for alternatives in self.depends(name):
+                    found = [found for dep in alternatives for found in self.candidates(dep)]
+                    if not found:
+                        todo.append(name)
+                    for provider in found:
+                        rdepends.setdefault(provider, set()).add(name)
+            broken = set()
+            while todo:
+                name = todo.pop()
+                if name in broken:
+                    continue
+                broken.add(name)
+                todo.extend(rdep for rdep in rdepends.get(name, ()) if not self.satisfiable(rdep, broken))
+            self._broken = broken
+        return self._broken
+
+    def closure(self, relations: list[list[dict]]) -> tuple[set[str], list[str]]:
+        # picks the first installable alternative of every dependency, like apt
+        # mostly does; conflicts are not considered
+        installed = set()
+        unsatisfiable = []
+        todo = list(relations)
+        while todo:
+            alternatives = todo.pop()
+            if any(name in installed for dep in alternatives for name in self.candidates(dep)):
+                continue
+            for dep in alternatives:
+                # skips a broken alternative, so only relations none of whose
+                # alternatives can be installed are unsatisfiable
+                if found := [name for name in self.candidates(dep) if name not in self.broken()]:
+                    installed.add(found[0])
+                    todo.extend(self.depends(found[0]))
+                    break
+            else:
+                unsatisfiable.append(deb822.PkgRelation.str([alternatives]))
+        return installed, unsatisfiable
@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+import argparse
+import contextlib
+import cProfile
+import gzip
+import json
+import os
+import pstats
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import yaml
+
+import filter_results
+import find_sources_installing
+import tally_results
+
+SECTIONS = ["admin", "libs", "net", "utils", "devel", "kernel", "misc"]
+
+PATH_PREFIXES = [
+    "usr/bin/",
+    "usr/lib/x86_64-linux-gnu/",
+    "usr/share/doc/",
+    "usr/share/man/man1/",
+    "etc/",
+    "lib/udev/rules.d/",
+    "lib/systemd/system/",
+    "lib/x86_64-linux-gnu/security/",
+    "lib/firmware/",
+    "bin/",
+    "sbin/",
+]
+
+GUESSED_STATUSES = [
+    "bug-filed",
+    "needs-binnmu",
+    "needs-inspection",
+    "needs-no-change-upload",
+    "patch-in-bts",
+    "patch-marked-pending",
+]
+
+GROUPS = ["bin", "lib-other", "multiple", "pam", "sbin", "systemd", "udev"]
+
+# items per unit of --scale
+SCALE = {
+    "contents_paths": 20000,
+    "binaries": 2000,
+    "buildlogs": 100,
+    "bugs": 50,
+    "tally_entries": 1000,
+}
+
+SBUILD_RULE = b"+" + b"-" * 78 + b"+\n"
+
+
+def sbuild_header(title: str) -> bytes:
+    return b"\n" + SBUILD_RULE + f"| {title}".ljust(79).encode() + b"|\n" + SBUILD_RULE + b"\n"
+
+
+def bin_name(i: int) -> str:
+    return f"bin{i:06d}"
+
+
+def src_name(i: int) -> str:
+    return f"src{i // 3:06d}"
+
+
+def random_path(rng: random.Random, i: int) -> str:
+    return f"{rng.choice(PATH_PREFIXES)}file{i:07d}"
+
+
+def gen_contents(path: Path, rng: random.Random, n_paths: int, n_binaries: int):
+    with gzip.open(path, "wt", compresslevel=1) as fp:
+        for i in range(n_paths):
+            owners = [f"{rng.choice(SECTIONS)}/{bin_name(rng.randrange(n_binaries))}" for _ in range(rng.randint(1, 2))]
+            fp.write(f"{random_path(rng, i):<60} {','.join(owners)}\n")
+
+
+def gen_packages(path: Path, rng: random.Random, n_binaries: int):
+    with gzip.open(path, "wt", compresslevel=1) as fp:
+        for i in range(n_binaries):
+            fp.write(f"Package: {bin_name(i)}\n")
+            if i % 3:
+                fp.write(f"Source: {src_name(i)} (1.{i % 5}-1)\n")
+            else:
+                fp.write(f"Source: {src_name(i)}\n")
+            fp.write(f"Version: 1.{i % 5}-1\n")
+            fp.write("Architecture: amd64\n")
+            fp.write(f"Depends: libc6 (>= 2.36), {bin_name(rng.randrange(n_binaries))}\n")
+            fp.write(f"Description: synthetic package {i}\n\n")
+
+
+def gen_buildlog(path: Path, rng: random.Random, n_files: int, n_binaries: int, fail: bool):
+    with path.open("wb") as fp:
+        fp.write(sbuild_header("Update chroot"))
+        fp.write(b"Get:1 file:/srv/debian-mirror/mirror unstable InRelease\n" * 5)
+        fp.write(sbuild_header("Build"))
+        fp.write(b"Architecture: any all\n")
+        fp.write(b"dh_auto_build\nmake[1]: Entering directory '/build/src'\n" * 200)
+        if not fail:
+            fp.write(sbuild_header("Package contents"))
+            for _ in range(rng.randint(1, 3)):
+                fp.write(f" Package: {bin_name(rng.randrange(n_binaries))}\n".encode())
+                for j in range(n_files):
+                    entry = f"-rw-r--r-- root/root     1234 2023-12-01 12:00 ./{random_path(rng, j)}\n"
+                    fp.write(entry.encode())
+        fp.write(sbuild_header("Summary"))
+        fp.write(b"Build Architecture: amd64\n")
+        if fail:
+            fp.write(b"Fail-Stage: build\n")
+        else:
+            fp.write(b"Status: successful\n")
+
+
+def gen_bugs(n_bugs: int, rng: random.Random, n_sources: int) -> list[dict]:
+    bugs = []
+    for i in range(n_bugs):
+        bugs.append(
+            {
+                "id": 1000000 + i,
+                "source": src_name(rng.randrange(n_sources * 3)),
+                "severity": "serious",
+                "title": f"synthetic bug {i}",
+                "last_modified": "2023-12-01 12:00:00",
+                "status": "pending",
+                "affects_testing": True,
+                "affects_unstable": True,
+                "affects_experimental": False,
+                "lastupload": "2023-11-01",
+                "tags": rng.sample(["patch", "pending", "moreinfo", "ftbfs"], rng.randint(0, 2)),
+            }
+        )
+    return bugs
+
+
+def gen_tally(path: Path, shards_dir: Path, rng: random.Random, n_entries: int) -> dict:
+    work_todo = {}
+    for i in range(n_entries):
+        work_todo[src_name(i * 3)] = {
+            "bugs": [],
+            "groups": sorted(rng.sample(GROUPS, rng.randint(1, 3))),
+            "guessed_status": rng.choice(GUESSED_STATUSES),
+            "build_result": {"version": "1.0-1", "built": None, "bin_pkgs": [], "architecture": ["any"]},
+        }
+    with path.open("w") as fp:
+        yaml.safe_dump_all([{"___meta": {}}, {"___stats": {}}, work_todo], fp)
+    with contextlib.redirect_stdout(None):
+        tally_results.write_sharded_output(shards_dir, {"___meta": {}, "___stats": {}}, {"todo": work_todo})
+    return work_todo
+
+
+def generate_fixtures(root: Path, scale: int, seed: int) -> dict:
+    rng = random.Random(seed)
+    n_binaries = SCALE["binaries"] * scale
+    n_buildlogs = SCALE["buildlogs"] * scale
+
+    print("Generating fixtures in", root, f"(scale={scale}, seed={seed})")
+    fixtures = {
+        "contents": root / "Contents-amd64.gz",
+        "packages": root / "Packages.gz",
+        "buildlogs_dir": root / "buildlogs",
+        "rebuild_list": root / "sources-unmerged",
+        "cache_dir": root / "cache",
+        "tally": root / "demar-tally.yaml",
+        "tally_dir": root / "tally",
+    }
+    gen_contents(fixtures["contents"], rng, SCALE["contents_paths"] * scale, n_binaries)
+    gen_packages(fixtures["packages"], rng, n_binaries)
+
+    # a reused --fixtures-dir is regenerated, logs of an earlier scale or seed must not linger
+    for dirname in ("buildlogs_dir", "cache_dir", "tally_dir"):
+        shutil.rmtree(fixtures[dirname], ignore_errors=True)
+        fixtures[dirname].mkdir()
+    wanted = []
+    for i in range(n_buildlogs):
+        name = f"{src_name(i * 3)}_1.{i % 5}-1"
+        wanted.append(name)
+        # leave a few unbuilt to exercise the no-build-result path
+        if i % 10 == 9:
+            continue
+        gen_buildlog(fixtures["buildlogs_dir"] / name, rng, rng.randint(5, 60), n_binaries, fail=(i % 7 == 0))
+    fixtures["rebuild_list"].write_text("\n".join(wanted) + "\n")
+
+    for selector in ("ftbfs", "dep17"):
+        with (fixtures["cache_dir"] / f"bugs-{selector}").open("w") as fp:
+            json.dump(gen_bugs(SCALE["bugs"] * scale, rng, n_buildlogs), fp)
+
+    # filter_results is timed on the loaded tally, not on parsing it
+    fixtures["tally_results"] = gen_tally(fixtures["tally"], fixtures["tally_dir"], rng, SCALE["tally_entries"] * scale)
+    return fixtures
+
+
+def stage_find_bin_pkgs(fixtures: dict) -> int:
+    finder = find_sources_installing.FINDERS["usrmerge"]
+    find_sources_installing.find_bin_pkgs_with_paths(fixtures["contents"], finder)
+    return SCALE["contents_paths"] * fixtures["scale"]
+
+
+def stage_source_versions(fixtures: dict) -> int:
+    bin_pkgs = {bin_name(i) for i in range(0, SCALE["binaries"] * fixtures["scale"], 2)}
+    find_sources_installing.update_source_versions(fixtures["packages"], bin_pkgs, {}, set())
+    return SCALE["binaries"] * fixtures["scale"]
+
+
+def stage_get_build_results(fixtures: dict) -> int:
+    tally_results.CACHE_DIR = fixtures["cache_dir"]
+    results = tally_results.get_build_results(str(fixtures["rebuild_list"]), str(fixtures["buildlogs_dir"]))
+    return len(results)
+
+
+def stage_filter_results(fixtures: dict) -> int:
+    results = fixtures["tally_results"]
+    for how in ("udev", "special", "status:needs-binnmu"):
+        filter_results.filter_results(results, filter_results.get_matcher(how))
+    return len(results)
+
+
+def stage_read_results_sharded(fixtures: dict) -> int:
+    # what cron/tally publishes and filter_results reads through --output-dir
+    return len(filter_results.read_results(str(fixtures["tally_dir"]), "todo"))
+
+
+STAGES = {
+    "find_bin_pkgs_with_paths": stage_find_bin_pkgs,
+    "update_source_versions": stage_source_versions,
+    "get_build_results": stage_get_build_results,
+    "filter_results": stage_filter_results,
+    "read_results_sharded": stage_read_results_sharded,
+}
+
+
+def run_stage(name: str, stage, fixtures: dict, args: argparse.Namespace) -> dict:
+    profiler = cProfile.Profile() if args.profile else None
+    if args.tracemalloc:
+        tracemalloc.start()
+
+    # the stages print progress for every item, which would dominate the timing
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        if profiler:
+            profiler.enable()
+        items = stage(fixtures)
+        if profiler:
+            profiler.disable()
+        seconds = time.perf_counter() - start
+
+    result = {"seconds": seconds, "items": items, "items_per_second": items / seconds if seconds else None}
+    # the process-wide max RSS only grows from stage to stage, so it is not reported
+    if args.tracemalloc:
+        result["peak_bytes"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    if profiler:
+        if args.profile_dir:
+            profiler.dump_stats(Path(args.profile_dir) / f"{name}.prof")
+        else:
+            print(f"--- profile: {name}")
+            pstats.Stats(profiler).sort_stats("cumulative").print_stats(args.profile_limit)
+
+    return result
+
+
+def check_regressions(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    regressions = []
+    if baseline.get("scale") != results["scale"]:
+        raise ValueError(f"baseline was recorded with scale {baseline.get('scale')}, not {results['scale']}")
+
+    for name, result in results["stages"].items():
+        expected = baseline["stages"].get(name)
+        if not expected:
+            continue
+        for key in ("seconds", "peak_bytes"):
+            if key in expected and key in result and result[key] > expected[key] * tolerance:
+                regressions.append(f"{name}: {key} {result[key]:.3f} > {expected[key]:.3f} * {tolerance}")
+    return regressions
+
+
+def format_bytes(value: int) -> str:
+    return f"{value / (1024 * 1024):.1f} MiB"
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark the tally/find/filter pipeline on synthetic inputs")
+    parser.add_argument("--scale", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--stage", dest="stages", action="append", choices=STAGES.keys())
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--profile", default=False, action="store_true")
+    parser.add_argument("--profile-dir", dest="profile_dir")
+    parser.add_argument("--profile-limit", dest="profile_limit", type=int, default=20)
+    parser.add_argument("--tracemalloc", default=False, action="store_true")
+    parser.add_argument("--fixtures-dir", dest="fixtures_dir")
+    parser.add_argument("--baseline", type=argparse.FileType(mode="r"))
+    parser.add_argument("--save-baseline", dest="save_baseline")
+    parser.add_argument("--tolerance", type=float, default=1.25)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    stages = args.stages or list(STAGES.keys())
+
+    with tempfile.TemporaryDirectory(prefix="demar-bench-") as tmpdir:
+        root = Path(args.fixtures_dir or tmpdir)
+        root.mkdir(parents=True, exist_ok=True)
+        fixtures = generate_fixtures(root, args.scale, args.seed) | {"scale": args.scale}
+
+        results = {"scale": args.scale, "seed": args.seed, "stages": {}}
+        for name in stages:
+            runs = [run_stage(name, STAGES[name], fixtures, args) for _ in range(args.repeat)]
+            best = min(runs, key=lambda run: run["seconds"])
+            results["stages"][name] = best
+            print(
+                f"{name:<28} {best['seconds']:8.3f}s {best['items']:>9} items",
+                f"{best['items_per_second']:12.0f} items/s" if best["items_per_second"] else "",
+                f"peak {format_bytes(best['peak_bytes'])}" if "peak_bytes" in best else "",
+            )
+
+    if args.save_baseline:
+        with Path(args.save_baseline).open("w") as fp:
+            json.dump(results, fp, indent=2)
+
+    if args.baseline:
+        regressions = check_regressions(results, json.load(args.baseline), args.tolerance)
+        if regressions:
+            print("Regressions:", *regressions, sep="\n  ", file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+import asyncio
+import json
+import os
+import pathlib
+import threading
+import time
+
+STATUS_INTERVAL = 10  # seconds between status file updates
+DEFAULT_BUILD_DURATION = 15 * 60  # ETA guess until the first build finishes
+
+SBUILD_RULE = b"+------------------------------------------------------------------------------+"
+
+
+class LogTail:
+    def __init__(self, path: pathlib.Path):
+        self.path = path
+        self.offset = 0
+        self.rest = b""
+        self.after_rule = False
+        self.phase = "starting"
+
+    def poll(self):
+        try:
+            with self.path.open("rb") as fp:
+                fp.seek(self.offset)
+                data = fp.read()
+        except FileNotFoundError:
+            return
+        self.offset += len(data)
+
+        lines = (self.rest + data).split(b"\n")
+        self.rest = lines.pop()
+        for line in lines:
+            line = line.rstrip()
+            # sbuild section headers are a title line framed by two rules
+            if self.after_rule and line.startswith(b"| "):
+                self.phase = line.strip(b"| ").split(b"  ")[0].decode(errors="replace")
+            self.after_rule = line.startswith(SBUILD_RULE)
+
+
+class BuildStatus:
+    def __init__(self, status_file: pathlib.Path, status_socket: pathlib.Path | None, max_parallel: int):
+        self.status_file = status_file
+        self.status_socket = status_socket
+        self.max_parallel = max_parallel
+        self.started = time.time()
+        self.queued: dict[str, pathlib.Path] = {}
+        self.running: dict[str, dict] = {}
+        self.finished: dict[str, dict] = {}
+        self.lock = threading.Lock()
+        self.thread = None
+        self.loop = None
+        self.stopping = asyncio.Event()
+
+    def set_queued(self, items: list[tuple[str, pathlib.Path]]):
+        # replaces the queued items, e.g. with the current backlog of the work queue
+        with self.lock:
+            self.queued = {name: buildlog for name, buildlog in items if name not in self.running}
+
+    def finish(self, name: str, status: str):
+        now = time.time()
+        with self.lock:
+            self.queued.pop(name, None)
+            running = self.running.pop(name, None)
+            started = running["started"] if running else now
+            self.finished[name] = {"status": status, "started": started, "duration": now - started}
+
+    def average_duration(self) -> float:
+        durations = [f["duration"] for f in self.finished.values() if f["duration"] > 0]
+        if not durations:
+            return DEFAULT_BUILD_DURATION
+        return sum(durations) / len(durations)
+
+    def poll(self):
+        with self.lock:
+            for name, buildlog in list(self.queued.items()):
+                try:
+                    mtime = buildlog.stat().st_mtime
+                except FileNotFoundError:
+                    continue
+                # ignore leftovers of an earlier, interrupted run
+                if mtime < self.started:
+                    continue
+                del self.queued[name]
+                self.running[name] = {"started": time.time(), "tail": LogTail(buildlog)}
+
+        for running in list(self.running.values()):
+            running["tail"].poll()
+
+    def snapshot(self) -> dict:
+        now = time.time()
+        with self.lock:
+            average = self.average_duration()
+            running = {
+                name: {
+                    "phase": r["tail"].phase,
+                    "elapsed": now - r["started"],
+                    "eta": r["started"] + average,
+                }
+                for name, r in self.running.items()
+            }
+            remaining = len(self.queued) + len(self.running)
+            return {
+                "updated": now,
+                "started": self.started,
+                "average_duration": average,
+                "eta": now + remaining * average / self.max_parallel,
+                "counts": {"queued": len(self.queued), "running": len(self.running), "finished": len(self.finished)},
+                "running": running,
+                "queued": list(self.queued.keys()),
+                "finished": dict(self.finished),
+            }
+
+    def write(self):
+        new_file = self.status_file.with_name(f"{self.status_file.name}.new")
+        with new_file.open("w") as fp:
+            json.dump(self.snapshot(), fp, indent=1)
+        os.replace(new_file, self.status_file)
+
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        writer.write(json.dumps(self.snapshot()).encode() + b"\n")
+        await writer.drain()
+        writer.close()
+
+    async def run(self):
+        server = None
+        if self.status_socket:
+            self.status_socket.unlink(missing_ok=True)
+            server = await asyncio.start_unix_server(self.handle_client, path=str(self.status_socket))
+
+        while not self.stopping.is_set():
+            self.poll()
+            self.write()
+            try:
+                await asyncio.wait_for(self.stopping.wait(), STATUS_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+        if server:
+            server.close()
+            await server.wait_closed()
+            self.status_socket.unlink(missing_ok=True)
+        self.write()
+
+    def start(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_until_complete, args=(self.run(),), daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.stopping.set)
+        self.thread.join()
@@ -10,6 +10,7 @@ def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(description="filter tallied results")
     parser.add_argument("--plain", default=False, action="store_true")
     parser.add_argument("--aux-list", type=argparse.FileType(mode="r"))
+    parser.add_argument("--list", default="todo", choices=["todo", "need-rebuild"])
     parser.add_argument("filename")
     parser.add_argument("how")
     return parser.parse_args()
@@ -46,38 +47,58 @@ def parse_aux_file(fp):
     return [p.split("_")[0] for p in fp.read().splitlines()]
 
 
-def main():
-    args = parse_args()
-    how = args.how
-
-    if args.aux_list:
-        aux_list = parse_aux_file(args.aux_list)
-    else:
-        aux_list = None
-
-    with Path(args.filename).open("r") as fp:
-        data = list(yaml.safe_load_all(fp))
-
-    results = data[-1]
-
-    filtered = {}
-
+def get_matcher(how: str):
     if how == "udev":
-        matcher = match_udev
+        return match_udev
     elif how == "special":
-        matcher = match_special
+        return match_special
     elif how.startswith("status:"):
         s = how.split(":")[1]
-        matcher = lambda detail: tpl_match_status(s, detail)
+        return lambda detail: tpl_match_status(s, detail)
     else:
         raise ValueError(f"unknown how: {how}")
 
+
+def read_results(filename: str, list_name: str) -> dict:
+    path = Path(filename)
+    if not path.is_dir():
+        with path.open("r") as fp:
+            return list(yaml.safe_load_all(fp))[-1]
+
+    # tally_results --output-dir layout, one file per source
+    loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+    results = {}
+    for file in sorted((path / "sources").glob("*/*.yaml")):
+        with file.open("r") as fp:
+            detail = yaml.load(fp, Loader=loader)
+        if detail.pop("list") == list_name:
+            results[file.stem] = detail
+    return results
+
+
+def filter_results(results: dict, matcher, aux_list=None) -> dict:
+    filtered = {}
     for src_name, detail in results.items():
         if aux_list is not None and src_name not in aux_list:
             continue
 
         if matcher(detail):
             filtered[src_name] = detail
+    return filtered
+
+
+def main():
+    args = parse_args()
+    how = args.how
+
+    if args.aux_list:
+        aux_list = parse_aux_file(args.aux_list)
+    else:
+        aux_list = None
+
+    results = read_results(args.filename, args.list)
+
+    filtered = filter_results(results, get_matcher(how), aux_list)
 
     if args.plain:
         print("\n".join(filtered.keys()))
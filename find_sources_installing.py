@@ -7,34 +7,58 @@ import sys
 from debian import deb822
 from debian.debian_support import version_compare
 
+import index_server
+import path_table
+
 ARCHS = ["all", "arm64", "amd64"]
 COMPONENTS = ["main", "contrib", "non-free", "non-free-firmware"]
 
+# path prefixes, usable both for scanning Contents and for path_table queries
 FINDERS = {
-    "udev": lambda path: path.startswith("lib/udev/"),
-    "systemd": lambda path: path.startswith("lib/systemd/"),
-    "udevsystemd": lambda path: path.startswith("lib/udev/") or path.startswith("lib/systemd/"),
-    "usrmerge": lambda path: path.startswith("lib/") or path.startswith("bin/") or path.startswith("sbin/"),
-    "pam": lambda path: path.startswith("lib/x86_64-linux-gnu/security/")
-    or path.startswith("usr/lib/x86_64-linux-gnu/security/"),
+    "udev": ("lib/udev/",),
+    "systemd": ("lib/systemd/",),
+    "udevsystemd": ("lib/udev/", "lib/systemd/"),
+    "usrmerge": ("lib/", "bin/", "sbin/"),
+    "pam": ("lib/x86_64-linux-gnu/security/", "usr/lib/x86_64-linux-gnu/security/"),
 }
 
 
-def find_bin_pkgs_with_paths(contents: pathlib.Path, finder) -> set[str]:
+def find_bin_pkgs_with_paths(contents: pathlib.Path, finder: tuple[str, ...]) -> set[str]:
     bin_pkgs = set()
     with gzip.open(contents, "rt") as fp:
         for line in fp:
             path, packages = line.strip().split(maxsplit=1)
-            if finder(path):
+            if path.startswith(finder):
                 for package in packages.split(","):
                     bin_pkgs.add(package.rsplit("/", 1)[1])
 
     return bin_pkgs
 
 
+def update_source_versions(
+    pkglist_file: pathlib.Path, bin_pkgs: set[str], source_pkg_versions: dict[str, str], found_bin_pkgs: set[str]
+):
+    with gzip.open(pkglist_file, "rt") as pkglist:
+        for pkg in deb822.Packages.iter_paragraphs(pkglist):
+            bin_name = pkg["Package"]
+            if pkg["Package"] not in bin_pkgs:
+                continue
+
+            found_bin_pkgs.add(bin_name)
+
+            source_name = pkg.source
+            source_version = pkg.source_version
+            other_ver = source_pkg_versions.get(source_name)
+            if other_ver and version_compare(other_ver, source_version) >= 0:
+                continue
+            source_pkg_versions[source_name] = source_version
+
+
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(description="Find sources installing paths into binaries")
     parser.add_argument("finder", choices=FINDERS.keys())
+    parser.add_argument("--server", default=False, action="store_true")
+    parser.add_argument("--path-table", dest="path_table", default=False, action="store_true")
     return parser.parse_args()
 
 
@@ -47,29 +71,34 @@ def main():
     args = parse_args()
     finder = FINDERS[args.finder]
 
-    for component in COMPONENTS:
-        for arch in ARCHS:
-            bin_pkgs.update(
-                find_bin_pkgs_with_paths(pathlib.Path(f"{mirror}/dists/sid/{component}/Contents-{arch}.gz"), finder)
-            )
-
-    for component in COMPONENTS:
-        for arch in ARCHS:
-            pkglist_file = pathlib.Path(f"{mirror}/dists/sid/{component}/binary-{arch}/Packages.gz")
-            with gzip.open(pkglist_file, "rt") as pkglist:
-                for pkg in deb822.Packages.iter_paragraphs(pkglist):
-                    bin_name = pkg["Package"]
-                    if pkg["Package"] not in bin_pkgs:
-                        continue
-
-                    found_bin_pkgs.add(bin_name)
-
-                    source_name = pkg.source
-                    source_version = pkg.source_version
-                    other_ver = source_pkg_versions.get(source_name)
-                    if other_ver and version_compare(other_ver, source_version) >= 0:
-                        continue
-                    source_pkg_versions[source_name] = source_version
+    if args.path_table:
+        table = path_table.open_table()
+        bin_pkgs = table.owners(table.find_prefixes(finder))
+    else:
+        for component in COMPONENTS:
+            for arch in ARCHS:
+                contents = pathlib.Path(f"{mirror}/dists/sid/{component}/Contents-{arch}.gz")
+                bin_pkgs.update(find_bin_pkgs_with_paths(contents, finder))
+
+    binary_sources = None
+    if args.server:
+        try:
+            binary_sources = index_server.query("binary_sources", sorted(bin_pkgs))
+        except OSError as exc:
+            print("Index server unreachable, reading Packages instead:", exc, file=sys.stderr)
+
+    if binary_sources is not None:
+        for bin_name, found in binary_sources.items():
+            found_bin_pkgs.add(bin_name)
+            other_ver = source_pkg_versions.get(found["source"])
+            if other_ver and version_compare(other_ver, found["version"]) >= 0:
+                continue
+            source_pkg_versions[found["source"]] = found["version"]
+    else:
+        for component in COMPONENTS:
+            for arch in ARCHS:
+                pkglist_file = pathlib.Path(f"{mirror}/dists/sid/{component}/binary-{arch}/Packages.gz")
+                update_source_versions(pkglist_file, bin_pkgs, source_pkg_versions, found_bin_pkgs)
 
     source_pkgs = set()
     for source_name, source_version in source_pkg_versions.items():
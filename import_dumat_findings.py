@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import sqlite3
+from pathlib import Path
+
+import yaml
+
+import archive
+
+FINDINGS_TABLE = "demar_findings"
+
+# analyze.py names the binary packages involved in a finding, by name or as
+# name:arch, either directly or as a {"name": ...} mapping
+BINARY_KEYS = ("package", "packages", "binary", "binaries")
+BINARY_SOURCES_ARCH = "amd64"
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Store dumat analyzer findings in an indexed table of the dumat DB")
+    parser.add_argument("db")
+    parser.add_argument("findings", type=argparse.FileType(mode="r"))
+    return parser.parse_args()
+
+
+def iter_findings(documents):
+    # analyze.py writes a YAML stream, each document a finding or a list of them
+    for i, doc in enumerate(documents):
+        if isinstance(doc, list) and all(isinstance(finding, dict) for finding in doc):
+            yield from doc
+        elif isinstance(doc, dict):
+            yield doc
+        elif doc is not None:
+            raise ValueError(f"analyzer document {i} is a {type(doc).__name__}, not a finding")
+
+
+def binary_names(value) -> set[str]:
+    if isinstance(value, str):
+        return {value.split(":")[0]}
+    if isinstance(value, dict):
+        return binary_names(value.get("name") or value.get("package"))
+    if isinstance(value, list):
+        return set().union(*(binary_names(item) for item in value))
+    return set()
+
+
+def finding_sources(finding: dict, binary_sources: dict[str, str]) -> set[str]:
+    if not any(finding.get(key) for key in ("source", *BINARY_KEYS)):
+        raise ValueError(f"analyzer finding names no package, its keys are {sorted(finding)}")
+    sources = set()
+    if source := finding.get("source"):
+        sources.add(str(source).split("_")[0])
+    for key in BINARY_KEYS:
+        sources.update(binary_sources[name] for name in binary_names(finding.get(key)) if name in binary_sources)
+    return sources
+
+
+def main():
+    args = parse_args()
+
+    print("Reading binary to source mapping for", BINARY_SOURCES_ARCH)
+    binary_sources = archive.read_binary_sources(BINARY_SOURCES_ARCH)
+
+    loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+    findings = 0
+    unmapped = 0
+    stored = 0
+    with sqlite3.connect(Path(args.db)) as conn:
+        conn.execute(f"DROP TABLE IF EXISTS {FINDINGS_TABLE}")
+        conn.execute(f"CREATE TABLE {FINDINGS_TABLE} (source TEXT NOT NULL, finding TEXT NOT NULL)")
+        # one finding at a time, the analyzer output is too big to hold
+        for finding in iter_findings(yaml.load_all(args.findings, Loader=loader)):
+            findings += 1
+            sources = finding_sources(finding, binary_sources)
+            if not sources:
+                unmapped += 1
+                continue
+            stored += len(sources)
+            finding_json = json.dumps(finding, default=str, sort_keys=True)
+            conn.executemany(
+                f"INSERT INTO {FINDINGS_TABLE} (source, finding) VALUES (?, ?)",
+                [(source, finding_json) for source in sorted(sources)],
+            )
+        # an empty table would silently drop all dumat findings from the tally
+        if findings and unmapped == findings:
+            raise ValueError(f"none of the {findings} analyzer findings names a package known in the archive")
+        conn.execute(f"CREATE INDEX {FINDINGS_TABLE}_source ON {FINDINGS_TABLE} (source)")
+
+    print("Stored", findings - unmapped, "of", findings, "dumat findings as", stored, "rows in", args.db)
+    if unmapped:
+        print("Ignored", unmapped, "findings naming no package known in the archive")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+import argparse
+import asyncio
+import json
+import pathlib
+import socket
+import sys
+
+from debian import deb822
+from debian.debian_support import version_compare
+
+import archive
+import mirror
+
+CACHE_DIR = pathlib.Path("~/.cache/demar").expanduser()
+SOCKET_PATH = CACHE_DIR / "index.sock"
+
+ARCHS = ["all", "arm64", "amd64"]
+RELOAD_CHECK_INTERVAL = 60  # seconds
+REQUEST_LIMIT = 64 * 1024 * 1024  # batched lookups can get long
+
+
+def packages_files() -> list[pathlib.Path]:
+    return [archive.packages_file(component, arch) for component in archive.COMPONENTS for arch in ARCHS]
+
+
+def split_source(para: dict[str, str]) -> tuple[str, str]:
+    source = para.get("Source", para["Package"])
+    if " " in source:
+        name, version = source.split(" ", 1)
+        return name, version.strip("()")
+    return source, para["Version"]
+
+
+class ArchiveIndex:
+    def __init__(self):
+        files = packages_files()
+        self.key = self.current_key(files)
+        paragraphs = archive.read_latest_paragraphs(files, deb822.Packages, ["Package", "Version", "Source"])
+
+        # names are interned, as most sources build several binaries
+        self.binary_sources: dict[str, tuple[str, str]] = {}
+        self.source_versions: dict[str, str] = {}
+        for bin_name, para in paragraphs.items():
+            source_name, source_version = split_source(para)
+            source_name = sys.intern(source_name)
+            self.binary_sources[bin_name] = (source_name, source_version)
+            other_ver = self.source_versions.get(source_name)
+            if other_ver and version_compare(other_ver, source_version) >= 0:
+                continue
+            self.source_versions[source_name] = source_version
+
+    @staticmethod
+    def current_key(files: list[pathlib.Path]) -> list[str | None]:
+        hash_cache = mirror.read_hash_cache()
+        return [mirror.cached_hash(file, hash_cache) for file in files]
+
+    def is_stale(self) -> bool:
+        return self.current_key(packages_files()) != self.key
+
+    def lookup(self, op: str, names: list[str]) -> dict:
+        if op == "source_versions":
+            return {name: self.source_versions[name] for name in names if name in self.source_versions}
+        elif op == "binary_sources":
+            return {
+                name: {"source": self.binary_sources[name][0], "version": self.binary_sources[name][1]}
+                for name in names
+                if name in self.binary_sources
+            }
+        raise ValueError(f"unknown op: {op}")
+
+
+class IndexServer:
+    def __init__(self):
+        print("Loading archive index")
+        self.index = ArchiveIndex()
+        print("Loaded", len(self.index.binary_sources), "binaries of", len(self.index.source_versions), "sources")
+        self.reload_lock = asyncio.Lock()
+
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        # one JSON request per line, answered by one JSON line
+        while line := await reader.readline():
+            await self.reload_if_stale()
+            try:
+                request = json.loads(line)
+                response = {"result": self.index.lookup(request["op"], request.get("names", []))}
+            except (ValueError, KeyError, TypeError) as exc:
+                response = {"error": str(exc)}
+            writer.write(json.dumps(response).encode() + b"\n")
+            await writer.drain()
+        writer.close()
+
+    async def reload_if_stale(self):
+        async with self.reload_lock:
+            if self.index.is_stale():
+                print("Mirror changed, reloading archive index", flush=True)
+                self.index = await asyncio.to_thread(ArchiveIndex)
+                print("Reloaded archive index", flush=True)
+
+    async def reload_when_stale(self):
+        # also checked before every request, so answers never predate a mirror update
+        while True:
+            await asyncio.sleep(RELOAD_CHECK_INTERVAL)
+            await self.reload_if_stale()
+
+    async def serve(self, socket_path: pathlib.Path):
+        socket_path.unlink(missing_ok=True)
+        server = await asyncio.start_unix_server(self.handle_client, path=str(socket_path), limit=REQUEST_LIMIT)
+        print("Serving archive index on", socket_path, flush=True)
+        async with server:
+            await asyncio.gather(server.serve_forever(), self.reload_when_stale())
+
+
+def query(op: str, names: list[str], socket_path: pathlib.Path = SOCKET_PATH) -> dict:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(str(socket_path))
+        sock.sendall(json.dumps({"op": op, "names": names}).encode() + b"\n")
+        sock.shutdown(socket.SHUT_WR)
+        with sock.makefile("rb") as fp:
+            response = json.loads(fp.readline())
+    if "error" in response:
+        raise RuntimeError(f"index server: {response['error']}")
+    return response["result"]
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Serve source/binary/version lookups from the local mirror")
+    parser.add_argument("--socket", type=pathlib.Path, default=SOCKET_PATH)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    args.socket.parent.mkdir(parents=True, exist_ok=True)
+    asyncio.run(IndexServer().serve(args.socket))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,82 @@
 #!/usr/bin/env python3
 import argparse
+import concurrent.futures
+import contextlib
 import datetime
+import fcntl
+import gzip
+import hashlib
+import json
 import multiprocessing
 import os
 import pathlib
+import re
 import subprocess
 import sys
 import random
+import shutil
+import signal
+import socket
 import time
 
 import yaml
 from debian import deb822
 
+import archive
+import build_status
+import repick
+import work_queue
+
 
 MAX_REPICK_COUNT = 20  # number of packages to re-pick every run
 MIN_REPICK_DELAY = 3 * 86400  # 3 days ago
+MAX_INVALIDATED_COUNT = 50  # rebuilds for changed build-deps per run, best ranked first
+
+BUILD_DEPENDS_RECORD = "build-depends.json"
+
+# build-deps which decide where files get installed; a new version of any of
+# these invalidates an existing build result. dpkg-dev is left out, being
+# build-essential it would invalidate every build at once
+INVALIDATING_BUILD_DEPS = {
+    "bash-completion",
+    "debhelper",
+    "dh-exec",
+    "libsystemd-dev",
+    "libudev-dev",
+    "pkg-config",
+    "pkgconf",
+    "pkgconf-bin",
+    "systemd",
+    "systemd-dev",
+    "udev",
+}
+
+# builds sharing the same build-dep closure get a chroot with it preinstalled
+SNAPSHOT_MIN_GROUP_SIZE = 3
+MAX_SNAPSHOTS = 8
+SNAPSHOT_TIMEOUT = 20 * 60  # seconds, the group then builds on the plain chroot
+SNAPSHOT_LOCK_FILE = "demar-snapshots.lock"
+SBUILD_CACHE_DIR = pathlib.Path("~/.cache/sbuild").expanduser()
+APT_SOURCES_LIST = pathlib.Path("~/.chdist/unstable/etc/apt/sources.list").expanduser()
+
+# per-build caps; sources exceeding them archive.RESOURCE_FAIL_LIMIT times are
+# skipped through the fail file in the job dir, which massrebuild maintains itself
+BUILD_TIMEOUT = 8 * 3600  # seconds
+BUILD_MEMORY_MAX = "24G"
+RESOURCE_LIMIT_STATUSES = {"build_timeout", "build_oom"}
+FAIL_FILE = "fail"
+
+# one ccache shared by all builds, bind-mounted at the same path into the chroot
+CCACHE_DIR = pathlib.Path("~/.cache/demar/ccache").expanduser()
+CCACHE_MAX_SIZE = "50G"
+CCACHE_PATH = "/usr/lib/ccache:/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin"
+CCACHE_SBUILDRC = f"""# generated by massrebuild, keeps the settings of ~/.sbuildrc
+if (open(my $fh, "<", "$ENV{{HOME}}/.sbuildrc")) {{ local $/; eval <$fh>; die $@ if $@; }}
+$unshare_bind_mounts = [ @{{ $unshare_bind_mounts // [] }}, {{ directory => $ENV{{CCACHE_DIR}}, mountpoint => $ENV{{CCACHE_DIR}} }} ];
+$build_environment = {{ %{{ $build_environment // {{}} }}, CCACHE_DIR => $ENV{{CCACHE_DIR}}, CCACHE_STATSLOG => $ENV{{CCACHE_STATSLOG}} }};
+$path = "{CCACHE_PATH}";
+1;
+"""
 
 
 def get_arch() -> str:
@@ -23,15 +85,30 @@ def get_arch() -> str:
 
 
 MY_ARCHITECTURE = get_arch()
+# keeps the historic target/ and buildlogs/ layout, which tally_results reads, whatever host a worker runs on
+PRIMARY_ARCHITECTURE = "amd64"
 
 
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(description="Rebuild a list of Debian source packages")
-    parser.add_argument("pkg_list", type=argparse.FileType(mode="r"))
+    parser.add_argument("pkg_list", type=argparse.FileType(mode="r"), nargs="?")
     parser.add_argument("job_name")
     parser.add_argument(
         "--extra-changes", dest="extra_changes", type=argparse.FileType(mode="r"), action="append", default=[]
     )
+    parser.add_argument("--arch", dest="archs", action="append", default=[])
+    parser.add_argument("--foreign-arch-mode", dest="foreign_arch_mode", choices=["qemu", "cross"], default="qemu")
+    parser.add_argument("--no-chroot-snapshots", dest="chroot_snapshots", default=True, action="store_false")
+    parser.add_argument("--no-preflight", dest="preflight", default=True, action="store_false")
+    parser.add_argument("--predictions", type=argparse.FileType(mode="r"))
+    parser.add_argument("--status-socket", dest="status_socket", default=False, action="store_true")
+    parser.add_argument("--metadata-only", dest="metadata_only", default=False, action="store_true")
+    parser.add_argument("--max-parallel", dest="max_parallel", type=int)
+    parser.add_argument("--ccache-dir", dest="ccache_dir", type=pathlib.Path, default=CCACHE_DIR)
+    parser.add_argument("--ccache-max-size", dest="ccache_max_size", default=CCACHE_MAX_SIZE)
+    parser.add_argument("--no-ccache", dest="ccache", default=True, action="store_false")
+    parser.add_argument("--build-timeout", dest="build_timeout", type=int, default=BUILD_TIMEOUT)
+    parser.add_argument("--build-memory-max", dest="build_memory_max", default=BUILD_MEMORY_MAX)
     return parser.parse_args()
 
 
@@ -57,16 +134,259 @@ def read_skip_file(filename: str):
         return {k.strip(): v.strip() for (k, v) in skip_reasons}
 
 
-def read_fail_file(job_dir: pathlib.Path) -> dict[str, str]:
-    file = job_dir / "fail"
+def write_fail_file(job_dir: pathlib.Path, fails: dict[str, tuple[int, str]]):
+    file = job_dir / FAIL_FILE
+    new_file = file.with_name(f"{file.name}.new")
+    with new_file.open("w") as fp:
+        for srcpkg_name, (count, reason) in sorted(fails.items()):
+            fp.write(f"{count} {srcpkg_name} {reason}\n")
+    new_file.replace(file)
+
+
+def get_learned_skip_reasons(job_dir: pathlib.Path) -> dict[str, str]:
+    return archive.fail_skip_reasons(archive.read_fail_file(job_dir / FAIL_FILE))
+
+
+def record_resource_failures(job_dir: pathlib.Path, results: list[dict]):
+    # several workers may finish at the same time
+    with (job_dir / f"{FAIL_FILE}.lock").open("w") as lock_fp:
+        fcntl.flock(lock_fp, fcntl.LOCK_EX)
+        fails = archive.read_fail_file(job_dir / FAIL_FILE)
+        for result in results:
+            for srcpkg, detail in result.items():
+                srcpkg_name = srcpkg.split("_")[0]
+                if detail["status"] in RESOURCE_LIMIT_STATUSES:
+                    count = fails.get(srcpkg_name, (0, ""))[0] + 1
+                    reason = f"{detail['status']} {srcpkg} {detail['arch']} {json.dumps(detail['detail'])}"
+                    fails[srcpkg_name] = (count, reason)
+                    print("Recorded", srcpkg, detail["arch"], "exceeding build limits", count, "times")
+                elif detail["status"] == "built":
+                    fails.pop(srcpkg_name, None)
+        write_fail_file(job_dir, fails)
+
+
+def get_arch_dirs(job_dir: pathlib.Path, arch: str) -> tuple[pathlib.Path, pathlib.Path]:
+    if arch == PRIMARY_ARCHITECTURE:
+        return job_dir / "target", job_dir / "buildlogs"
+    return job_dir / f"target-{arch}", job_dir / f"buildlogs-{arch}"
+
+
+def get_sbuild_arch_args(arch: str, foreign_arch_mode: str) -> list[str]:
+    if arch == MY_ARCHITECTURE:
+        return []
+    if foreign_arch_mode == "cross":
+        return [f"--host={arch}"]
+    # needs an unstable-{arch} chroot and qemu-user-static binfmt handlers
+    return [f"--arch={arch}"]
+
+
+def read_build_depends_record(build_dir: pathlib.Path) -> dict[str, dict]:
+    file = build_dir / BUILD_DEPENDS_RECORD
     if not file.exists():
         return {}
     with file.open("r") as fp:
-        fails = [line.split(" ", maxsplit=2) for line in fp.read().strip().splitlines()]
-        return {fail[1]: fail[2] for fail in fails}
+        return json.load(fp)
+
+
+@contextlib.contextmanager
+def locked_build_depends_record(build_dir: pathlib.Path):
+    # workers record their retries while the next run picks builds
+    with (build_dir / f"{BUILD_DEPENDS_RECORD}.lock").open("w") as lock_fp:
+        fcntl.flock(lock_fp, fcntl.LOCK_EX)
+        record = read_build_depends_record(build_dir)
+        yield record
+        file = build_dir / BUILD_DEPENDS_RECORD
+        new_file = file.with_name(f"{file.name}.new")
+        with new_file.open("w") as fp:
+            json.dump(record, fp)
+        new_file.replace(file)
+
+
+def write_build_depends_record(build_dir: pathlib.Path, record: dict[str, dict]):
+    with locked_build_depends_record(build_dir) as current:
+        for name, entry in record.items():
+            if name in current and current[name]["mtime"] == entry["mtime"] and "retried" in current[name]:
+                entry["retried"] = entry.get("retried", {}) | current[name]["retried"]
+        current.clear()
+        current.update(record)
+
+
+def record_build_deps_retried(build_dir: pathlib.Path, srcpkg: str, arch: str, changed: dict[str, str]):
+    # a failed rebuild leaves the old buildinfo in place, so every changed
+    # version is retried only once
+    with locked_build_depends_record(build_dir) as record:
+        if entry := record.get(f"{get_build_file_stem(srcpkg, arch)}.buildinfo"):
+            entry["retried"] = entry.get("retried", {}) | changed
+
+
+def get_installed_build_depends(record: dict[str, dict], buildinfo_file: pathlib.Path) -> dict[str, str]:
+    mtime = buildinfo_file.stat().st_mtime
+    entry = record.get(buildinfo_file.name)
+    if entry is None or entry["mtime"] != mtime:
+        entry = {"mtime": mtime, "installed": archive.read_installed_build_depends(buildinfo_file)}
+        record[buildinfo_file.name] = entry
+    return entry["installed"]
+
+
+def read_binary_indexes(archs: list[str]) -> dict[str, archive.BinaryIndex | None]:
+    binary_indexes = {}
+    for arch in archs:
+        try:
+            print("Reading Packages for", arch)
+            binary_indexes[arch] = archive.BinaryIndex(arch)
+        except OSError as exc:
+            print("Cannot read Packages for", arch, exc)
+            binary_indexes[arch] = None
+    return binary_indexes
+
+
+def read_sources() -> dict[str, dict[str, str]]:
+    try:
+        print("Reading Sources")
+        return archive.read_sources()
+    except OSError as exc:
+        print("Cannot read Sources", exc)
+        return {}
 
 
-def eval_status(build_dir: pathlib.Path, buildlog_dir: pathlib.Path, skip_reasons, srcpkg: str) -> dict | None:
+def resolve_build_depends(
+    picked: list[tuple[str, str]],
+    sources: dict[str, dict],
+    binary_indexes: dict[str, archive.BinaryIndex | None],
+    extra_pkgs: list[str],
+    foreign_arch_mode: str,
+) -> dict[tuple[str, str], tuple[set[str], list[str]]]:
+    provided_by_extra = {pathlib.Path(extra_pkg).name.split("_")[0] for extra_pkg in extra_pkgs}
+    resolved = {}
+    for srcpkg, arch in picked:
+        # cross builds need the host arch build-deps next to build arch tools,
+        # which the single-arch resolver cannot model
+        if arch != MY_ARCHITECTURE and foreign_arch_mode == "cross":
+            continue
+        source = sources.get(srcpkg.split("_")[0])
+        binary_index = binary_indexes.get(arch)
+        if source is None or binary_index is None:
+            continue
+        relations = [
+            alternatives
+            for alternatives in archive.get_build_depends(source, arch)
+            if not any(dep["name"] in provided_by_extra for dep in alternatives)
+        ]
+        resolved[(srcpkg, arch)] = binary_index.closure(relations)
+    return resolved
+
+
+def preflight_build_depends(
+    picked: list[tuple[str, str]], resolved: dict[tuple[str, str], tuple[set[str], list[str]]]
+) -> tuple[list[tuple[str, str]], list[dict]]:
+    installable = []
+    results = []
+    for srcpkg, arch in picked:
+        installed, unsatisfiable = resolved.get((srcpkg, arch), (set(), []))
+        if unsatisfiable:
+            print("Skipping", srcpkg, arch, "build-deps not installable:", ", ".join(unsatisfiable))
+            results.append(
+                wrap_result(
+                    srcpkg, {"arch": arch, "status": "bd-uninstallable", "detail": {"unsatisfiable": unsatisfiable}}
+                )
+            )
+        else:
+            installable.append((srcpkg, arch))
+    return installable, results
+
+
+def group_by_build_depends(
+    picked: list[tuple[str, str]], resolved: dict[tuple[str, str], tuple[set[str], list[str]]]
+) -> dict[tuple[str, frozenset[str]] | None, list[tuple[str, str]]]:
+    groups = {}
+    for srcpkg, arch in picked:
+        key = None
+        if (srcpkg, arch) in resolved:
+            installed, unsatisfiable = resolved[(srcpkg, arch)]
+            if not unsatisfiable:
+                key = (arch, frozenset(installed))
+        groups.setdefault(key, []).append((srcpkg, arch))
+    return groups
+
+
+def get_chroot_snapshot_name(arch: str, packages: frozenset[str]) -> str:
+    digest = hashlib.sha256(" ".join(sorted(packages)).encode()).hexdigest()[0:12]
+    return f"unstable-{arch}-bd-{digest}"
+
+
+def create_chroot_snapshot(chroot: str, arch: str, packages: list[str]) -> str | None:
+    # the first build of a group creates the snapshot, the others wait for it
+    tarball = SBUILD_CACHE_DIR / f"{chroot}.tar"
+    failed_file = SBUILD_CACHE_DIR / f"{chroot}.failed"
+    SBUILD_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    with (SBUILD_CACHE_DIR / SNAPSHOT_LOCK_FILE).open("w") as lock_fp:
+        fcntl.flock(lock_fp, fcntl.LOCK_EX)
+        if tarball.exists():
+            return chroot
+        if failed_file.exists():
+            return None
+
+        print("Creating chroot snapshot", chroot, "with", len(packages), "build-deps", flush=True)
+        # a run killed halfway must not leave a usable looking tarball behind
+        new_tarball = SBUILD_CACHE_DIR / f"{chroot}.new.tar"
+        proc = subprocess.Popen(
+            [
+                "mmdebstrap",
+                "--variant=buildd",
+                f"--architectures={arch}",
+                f"--include={','.join(sorted(packages))}",
+                "unstable",
+                str(new_tarball),
+                str(APT_SOURCES_LIST),
+            ],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            env=_create_subprocess_env_block(),
+            start_new_session=True,
+        )
+        try:
+            _, stderr = proc.communicate(timeout=SNAPSHOT_TIMEOUT)
+            error = stderr.decode().strip() if proc.returncode != 0 else None
+        except subprocess.TimeoutExpired:
+            kill_build(proc, None)
+            proc.communicate()
+            error = f"timed out after {SNAPSHOT_TIMEOUT}s"
+        if error is not None:
+            print("Creating chroot snapshot", chroot, "failed:", error)
+            new_tarball.unlink(missing_ok=True)
+            failed_file.touch()
+            return None
+        new_tarball.replace(tarball)
+    return chroot
+
+
+def remove_chroot_snapshot(chroot: str):
+    for suffix in (".tar", ".new.tar", ".failed"):
+        (SBUILD_CACHE_DIR / f"{chroot}{suffix}").unlink(missing_ok=True)
+
+
+def plan_chroot_snapshots(
+    picked: list[tuple[str, str]], resolved: dict[tuple[str, str], tuple[set[str], list[str]]]
+) -> tuple[list[tuple[str, str]], dict[tuple[str, str], dict]]:
+    groups = group_by_build_depends(picked, resolved)
+    ordered = sorted(groups.items(), key=lambda group: (group[0] is not None, len(group[1])), reverse=True)
+
+    # only planned here, the snapshots are created once their first build runs
+    chroots = {}
+    snapshot_count = 0
+    picked = []
+    for key, items in ordered:
+        if key is not None and len(items) >= SNAPSHOT_MIN_GROUP_SIZE and snapshot_count < MAX_SNAPSHOTS:
+            arch, packages = key
+            snapshot = {"name": get_chroot_snapshot_name(arch, packages), "packages": sorted(packages)}
+            chroots |= {item: snapshot for item in items}
+            snapshot_count += 1
+        # keep every group together, so builds on a snapshot run back-to-back
+        picked += items
+    return picked, chroots
+
+
+def get_build_file_stem(srcpkg: str, arch: str) -> str:
     if "_" in srcpkg:
         srcpkg_name = srcpkg.split("_")[0]
         srcpkg_version = srcpkg.split("_", 1)[1]
@@ -78,90 +398,348 @@ def eval_status(build_dir: pathlib.Path, buildlog_dir: pathlib.Path, skip_reason
     if ":" in binpkg_version:
         binpkg_version = binpkg_version.split(":", 1)[1]
 
-    buildinfo_file = build_dir / f"{srcpkg_name}_{binpkg_version}_{MY_ARCHITECTURE}.buildinfo"
+    return f"{srcpkg_name}_{binpkg_version}_{arch}"
 
-    if buildinfo_file.exists():
-        print("Skipping", srcpkg, "buildinfo exists")
-        return {"status": "already_built", "last_attempt": buildinfo_file.stat().st_mtime}
+
+def eval_status(
+    build_dir: pathlib.Path,
+    buildlog_dir: pathlib.Path,
+    skip_reasons,
+    srcpkg: str,
+    arch: str = MY_ARCHITECTURE,
+    build_depends_record: dict[str, dict] | None = None,
+    current_versions: dict[str, str] | None = None,
+) -> dict | None:
+    srcpkg_name = srcpkg.split("_")[0]
+    buildinfo_file = build_dir / f"{get_build_file_stem(srcpkg, arch)}.buildinfo"
 
     if broken_detail := skip_reasons.get(srcpkg_name):
-        print("Skipping", srcpkg, f"known broken: {broken_detail}")
+        print("Skipping", srcpkg, arch, f"known broken: {broken_detail}")
         return {"status": "known_broken", "detail": broken_detail}
 
+    if buildinfo_file.exists():
+        status = {"status": "already_built", "last_attempt": buildinfo_file.stat().st_mtime}
+        if build_depends_record is not None:
+            installed = get_installed_build_depends(build_depends_record, buildinfo_file)
+            status["build_depends"] = installed
+            if current_versions is not None:
+                retried = build_depends_record[buildinfo_file.name].get("retried", {})
+                invalidating = {
+                    name: current_versions.get(name)
+                    for name in archive.changed_build_depends(installed, current_versions)
+                    if name in INVALIDATING_BUILD_DEPS and retried.get(name, "") != current_versions.get(name)
+                }
+                if invalidating:
+                    print("Invalidating", srcpkg, arch, "build-deps changed:", " ".join(sorted(invalidating)))
+                    return status | {"status": "build_deps_changed", "detail": {"build_deps_changed": invalidating}}
+
+        print("Skipping", srcpkg, arch, "buildinfo exists")
+        return status
+
     buildlog_file = buildlog_dir / srcpkg
     if buildlog_file.exists():
-        print("Skipping", srcpkg, "buildlog exists, assuming old ftbfs")
+        print("Skipping", srcpkg, arch, "buildlog exists, assuming old ftbfs")
         return {"status": "old_ftbfs", "last_attempt": buildlog_file.stat().st_mtime}
 
     return {"status": "needs_build"}
 
 
-def wrap_result(srcpkg: str, result: dict) -> dict:
-    return {srcpkg: {"package": srcpkg} | result}
+def prioritize_ambiguous(picked: list[tuple[str, str]], predictions: dict[str, dict]):
+    # sort is stable, so everything else keeps its order
+    picked.sort(key=lambda item: not predictions.get(item[0].split("_")[0], {}).get("ambiguous", False))
 
 
-def main():
-    args = parse_args()
-    job_name = args.job_name
-    job_dir = pathlib.Path(f"./{job_name}").absolute()
-    job_dir.mkdir(exist_ok=True)
+def provision_ccache(ccache_dir: pathlib.Path, max_size: str, job_dir: pathlib.Path) -> dict[str, str]:
+    stats_dir = ccache_dir / "stats"
+    stats_dir.mkdir(parents=True, exist_ok=True)
+    # builds run as an unprivileged user of the unshare namespace, which has
+    # to be able to write into the cache
+    ccache_dir.chmod(0o777)
+    stats_dir.chmod(0o777)
+    # ccache evicts old entries by itself once max_size is exceeded
+    (ccache_dir / "ccache.conf").write_text(f"max_size = {max_size}\numask = 000\n")
+    sbuildrc = job_dir / "ccache.sbuildrc"
+    sbuildrc.write_text(CCACHE_SBUILDRC)
+    return {"dir": str(ccache_dir), "sbuildrc": str(sbuildrc)}
+
+
+def cleanup_ccache(ccache_dir: pathlib.Path):
+    if not shutil.which("ccache"):
+        return
+    env = {"CCACHE_DIR": str(ccache_dir), "PATH": os.environ["PATH"]}
+    subprocess.run(["ccache", "--cleanup"], env=env)
+    proc = subprocess.run(["ccache", "--show-stats"], env=env, stdout=subprocess.PIPE)
+    print(proc.stdout.decode().strip())
+
+
+def read_ccache_stats_log(stats_log: pathlib.Path) -> dict:
+    # one counter name per compiler invocation, preceded by a "# <input file>" line
+    if not stats_log.exists():
+        return {}
+    counters = {}
+    with stats_log.open("r") as fp:
+        for line in fp:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                counters[line] = counters.get(line, 0) + 1
+    stats_log.unlink()
+    return {
+        "hits": counters.get("direct_cache_hit", 0) + counters.get("preprocessed_cache_hit", 0),
+        "misses": counters.get("cache_miss", 0),
+        "counters": counters,
+    }
+
+
+def wrap_result(srcpkg: str, result: dict) -> dict:
+    return {srcpkg: {"package": srcpkg} | result}
 
-    build_dir = (job_dir / "target").absolute()
-    build_dir.mkdir(exist_ok=True)
-    print("Writing build files to", build_dir)
 
-    buildlog_dir = (job_dir / "buildlogs").absolute()
-    buildlog_dir.mkdir(exist_ok=True)
-    print("Writing buildlogs to", buildlog_dir)
+def pick_builds(
+    args: argparse.Namespace,
+    job_dir: pathlib.Path,
+    archs: list[str],
+    arch_dirs: dict[str, tuple[pathlib.Path, pathlib.Path]],
+) -> tuple[
+    list[tuple[str, str]], list[str], list[dict], dict[tuple[str, str], dict], dict[tuple[str, str], dict[str, str]]
+]:
+    skip_reasons = read_skip_file("skip_reasons") | get_learned_skip_reasons(job_dir)
 
-    skip_reasons = read_skip_file("skip_reasons")
+    binary_indexes = read_binary_indexes(archs)
+    current_versions = {arch: index.versions if index else None for arch, index in binary_indexes.items()}
 
     srcpkgs = [line.strip() for line in args.pkg_list.readlines()]
     srcpkg_status = {}
-    for srcpkg in srcpkgs:
-        srcpkg_status[srcpkg] = eval_status(build_dir, buildlog_dir, skip_reasons, srcpkg)
+    build_depends_records = {}
+    for arch in archs:
+        build_dir, buildlog_dir = arch_dirs[arch]
+        build_depends_records[arch] = read_build_depends_record(build_dir)
+        for srcpkg in srcpkgs:
+            srcpkg_status[(srcpkg, arch)] = eval_status(
+                build_dir, buildlog_dir, skip_reasons, srcpkg, arch, build_depends_records[arch], current_versions[arch]
+            )
 
     now = time.time()
     max_last_attempt = now - MIN_REPICK_DELAY
     picked = []
+    invalidated = []
+    retries = {}
     eligible_repick = []
-    for srcpkg, status in srcpkg_status.items():
+    for item, status in srcpkg_status.items():
         if status["status"] == "needs_build":
-            picked.append(srcpkg)
+            picked.append(item)
+        elif status["status"] == "build_deps_changed":
+            invalidated.append((*item, status))
         elif status.get("last_attempt", now) < max_last_attempt:
-            eligible_repick.append(srcpkg)
+            eligible_repick.append((*item, status))
+
+    # an upload of a widely used build-dep invalidates lots of results, spread
+    # their rebuilds over several runs
+    ranked = repick.rank_repick_candidates(invalidated, current_versions)[0:MAX_INVALIDATED_COUNT]
+    for score, srcpkg, arch, reasons in ranked:
+        changed = srcpkg_status[(srcpkg, arch)]["detail"]["build_deps_changed"]
+        print("Rebuilding", srcpkg, arch, f"score={score:.2f}", "build-deps changed:", " ".join(sorted(changed)))
+        picked.append((srcpkg, arch))
+        # recorded once the rebuild ran, it may still be dropped or never claimed
+        retries[(srcpkg, arch)] = changed
+    if len(invalidated) > len(ranked):
+        print("Postponing", len(invalidated) - len(ranked), "rebuilds for changed build-deps")
+
+    for arch in archs:
+        write_build_depends_record(arch_dirs[arch][0], build_depends_records[arch])
 
     count_repick_possible = MAX_REPICK_COUNT - len(picked)
-    if count_repick_possible > 0:
+    if count_repick_possible > 0 and eligible_repick:
         random.shuffle(eligible_repick)
-        eligible_repick = eligible_repick[0:count_repick_possible]
-        print("Repicking", " ".join(eligible_repick))
-        picked += eligible_repick
+        ranked = repick.rank_repick_candidates(eligible_repick, current_versions)[0:count_repick_possible]
+        for score, srcpkg, arch, reasons in ranked:
+            print("Repicking", srcpkg, arch, f"score={score:.2f}", " ".join(f"{k}={v:.2f}" for k, v in reasons.items()))
+            picked.append((srcpkg, arch))
 
     extra_pkgs = []
     for extra_fp in args.extra_changes:
         extra_pkgs.extend(get_extra_pkgs(extra_fp))
     print("Adding extra packages:", " ".join(extra_pkgs))
 
-    max_parallel = int(multiprocessing.cpu_count() * 1.6)
-    with multiprocessing.Pool(max_parallel) as pool:
-        results = pool.map(
-            do_build_one,
-            [(srcpkg, str(build_dir), str(buildlog_dir), extra_pkgs) for srcpkg in picked],
-            1,
-        )
+    resolved = resolve_build_depends(picked, read_sources(), binary_indexes, extra_pkgs, args.foreign_arch_mode)
+
+    results = []
+    if args.preflight:
+        picked, results = preflight_build_depends(picked, resolved)
+
+    chroots = {}
+    if args.chroot_snapshots:
+        picked, chroots = plan_chroot_snapshots(picked, resolved)
+
+    # after the snapshot planning, which reorders by group
+    if args.predictions:
+        print("Prioritizing sources with ambiguous predicted groups from", args.predictions.name)
+        prioritize_ambiguous(picked, yaml.safe_load(args.predictions) or {})
+
+    return picked, extra_pkgs, results, chroots, retries
 
-    with (job_dir / f"results{datetime.datetime.now().isoformat().replace(':', '_')}.yaml").open("w") as fp:
+
+def main():
+    args = parse_args()
+    job_name = args.job_name
+    job_dir = pathlib.Path(f"./{job_name}").absolute()
+    job_dir.mkdir(exist_ok=True)
+
+    archs = args.archs or [MY_ARCHITECTURE]
+    arch_dirs = {}
+    for arch in archs:
+        build_dir, buildlog_dir = get_arch_dirs(job_dir, arch)
+        build_dir.mkdir(exist_ok=True)
+        buildlog_dir.mkdir(exist_ok=True)
+        print(f"Writing {arch} build files to", build_dir, "and buildlogs to", buildlog_dir)
+        arch_dirs[arch] = (build_dir, buildlog_dir)
+
+    queue = work_queue.WorkQueue(job_dir / work_queue.QUEUE_FILE)
+    worker = f"{socket.gethostname()}:{os.getpid()}"
+
+    results = []
+    chroots = {}
+    if args.pkg_list:
+        picked, extra_pkgs, results, chroots, retries = pick_builds(args, job_dir, archs, arch_dirs)
+        queue.enqueue(
+            [
+                (
+                    srcpkg,
+                    arch,
+                    {
+                        "extra_pkgs": extra_pkgs,
+                        "chroot": chroots.get((srcpkg, arch)),
+                        "retry_build_deps": retries.get((srcpkg, arch)),
+                    },
+                )
+                for srcpkg, arch in picked
+            ]
+        )
+        print("Queued", len(picked), "builds in", job_dir / work_queue.QUEUE_FILE)
+        run_name = ""
+    else:
+        print("No package list given, only working on the queue in", job_dir / work_queue.QUEUE_FILE)
+        # several workers may share the job dir
+        run_name = f"-{socket.gethostname()}-{os.getpid()}"
+
+    ccache = None
+    if args.ccache:
+        ccache = provision_ccache(args.ccache_dir, args.ccache_max_size, job_dir)
+        print("Sharing ccache", ccache["dir"], "limited to", args.ccache_max_size)
+
+    max_parallel = args.max_parallel or int(multiprocessing.cpu_count() * 1.6)
+    status = build_status.BuildStatus(
+        job_dir / f"status{run_name}.json",
+        job_dir / f"status{run_name}.sock" if args.status_socket else None,
+        max_parallel,
+    )
+    print("Writing build status to", status.status_file)
+    status.start()
+
+    options = {
+        "foreign_arch_mode": args.foreign_arch_mode,
+        "metadata_only": args.metadata_only,
+        "ccache": ccache,
+        "timeout": args.build_timeout or None,
+        "memory_max": args.build_memory_max or None,
+    }
+    if options["memory_max"] and not can_limit_memory():
+        print("W: systemd-run or the user bus is missing, not enforcing the build memory limit", options["memory_max"])
+    # the wrap timeout ends the run with SIGTERM, the snapshots still have to go
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+    used_chroots = set()
+    try:
+        built = drain_queue(queue, worker, arch_dirs, options, max_parallel, status, used_chroots)
+    finally:
+        for chroot in used_chroots | {snapshot["name"] for snapshot in chroots.values()}:
+            remove_chroot_snapshot(chroot)
+    record_resource_failures(job_dir, built)
+    results += built
+    print("Queue state:", " ".join(f"{state}={count}" for state, count in queue.counts().items()))
+    queue.close()
+
+    status.stop()
+
+    if ccache:
+        cleanup_ccache(args.ccache_dir)
+
+    with (job_dir / f"results{datetime.datetime.now().isoformat().replace(':', '_')}{run_name}.yaml").open("w") as fp:
         yaml.safe_dump_all(results, fp)
 
 
+def drain_queue(
+    queue: work_queue.WorkQueue,
+    worker: str,
+    arch_dirs: dict[str, tuple[pathlib.Path, pathlib.Path]],
+    options: dict,
+    max_parallel: int,
+    status: build_status.BuildStatus,
+    used_chroots: set[str],
+) -> list[dict]:
+    results = []
+    running = {}
+    retries = {}
+    with concurrent.futures.ProcessPoolExecutor(max_parallel) as executor:
+        while True:
+            # claim only as many items as can run, the rest stays for other workers
+            while len(running) < max_parallel and (claimed := queue.claim(worker, list(arch_dirs.keys()))):
+                srcpkg, arch, payload = claimed
+                build_dir, buildlog_dir = arch_dirs[arch]
+                if payload["chroot"]:
+                    used_chroots.add(payload["chroot"]["name"])
+                workitem = (
+                    srcpkg,
+                    arch,
+                    str(build_dir),
+                    str(buildlog_dir),
+                    payload["extra_pkgs"],
+                    options | {"chroot": payload["chroot"]},
+                )
+                running[executor.submit(do_build_one, workitem)] = (srcpkg, arch)
+                retries[(srcpkg, arch)] = payload.get("retry_build_deps")
+            if not running:
+                break
+
+            # claimed items count as queued until their buildlog shows up
+            status.set_queued(
+                [
+                    (f"{srcpkg}/{arch}", arch_dirs[arch][1] / f"{srcpkg}.new")
+                    for srcpkg, arch in [*running.values(), *queue.pending(list(arch_dirs.keys()))]
+                ]
+            )
+            done, _ = concurrent.futures.wait(
+                running, timeout=work_queue.HEARTBEAT_INTERVAL, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                srcpkg, arch = running.pop(future)
+                retry_build_deps = retries.pop((srcpkg, arch))
+                try:
+                    result = future.result()
+                except Exception as exc:
+                    # finish the item anyway, instead of leaving the other leases to expire
+                    print("FAIL", srcpkg, arch, "(build raised an error)", repr(exc))
+                    error = {"arch": arch, "status": "build_error", "detail": {"error": repr(exc)}}
+                    result = wrap_result(srcpkg, error)
+                else:
+                    if retry_build_deps:
+                        record_build_deps_retried(arch_dirs[arch][0], srcpkg, arch, retry_build_deps)
+                if not queue.finish(worker, srcpkg, arch, result[srcpkg]):
+                    print("Lease on", srcpkg, arch, "expired before the build finished")
+                results.append(result)
+                status.finish(f"{srcpkg}/{arch}", result[srcpkg]["status"])
+            queue.heartbeat(worker, list(running.values()))
+
+    return results
+
+
 def do_build_one(workitem) -> dict:
-    srcpkg, build_dir, buildlog_dir, extra_pkgs = workitem
-    result = build_one(srcpkg, pathlib.Path(build_dir), pathlib.Path(buildlog_dir), extra_pkgs)
-    return wrap_result(srcpkg, result)
+    # only the main process cleans up on SIGTERM
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    srcpkg, arch, build_dir, buildlog_dir, extra_pkgs, options = workitem
+    result = build_one(srcpkg, arch, pathlib.Path(build_dir), pathlib.Path(buildlog_dir), extra_pkgs, options)
+    return wrap_result(srcpkg, {"arch": arch} | result)
 
 
-def _create_subprocess_env_block() -> dict:
+def _create_subprocess_env_block(ccache: dict | None = None, ccache_stats_log: pathlib.Path | None = None) -> dict:
     env = {
         "PATH": "/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin",
         "LC_ALL": "C.UTF-8",
@@ -170,15 +748,121 @@ def _create_subprocess_env_block() -> dict:
         "LOGNAME": os.getenv("LOGNAME"),
         "HOME": os.getenv("HOME"),
         "DEB_BUILD_OPTIONS": "nocheck",
+        "XDG_RUNTIME_DIR": str(get_user_runtime_dir()),
     }
+    if ccache:
+        env |= {
+            "SBUILD_CONFIG": ccache["sbuildrc"],
+            "CCACHE_DIR": ccache["dir"],
+            "CCACHE_STATSLOG": str(ccache_stats_log),
+        }
     env = {k: v for (k, v) in env.items() if k and v}
     return env
 
 
-def build_one(srcpkg: str, build_dir: pathlib.Path, buildlog_dir: pathlib.Path, extra_pkgs) -> dict:
+def get_user_runtime_dir() -> pathlib.Path:
+    # not set when running from cron
+    return pathlib.Path(os.getenv("XDG_RUNTIME_DIR") or f"/run/user/{os.getuid()}")
+
+
+def can_limit_memory() -> bool:
+    return bool(shutil.which("systemd-run")) and (get_user_runtime_dir() / "bus").exists()
+
+
+def get_resource_limit_args(unit: str, memory_max: str | None) -> list[str]:
+    if not memory_max or not can_limit_memory():
+        return []
+    # OOMPolicy=kill takes down the whole build; the scope then stays behind
+    # failed with Result=oom-kill until get_scope_result resets it
+    return [
+        "systemd-run",
+        "--user",
+        "--scope",
+        "--quiet",
+        f"--unit={unit}",
+        f"--property=MemoryMax={memory_max}",
+        "--property=MemorySwapMax=0",
+        "--property=OOMPolicy=kill",
+    ]
+
+
+def run_systemctl_user(*args: str) -> str:
+    proc = subprocess.run(
+        ["systemctl", "--user", *args],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        env=_create_subprocess_env_block(),
+    )
+    return proc.stdout.decode().strip()
+
+
+def get_scope_result(unit: str) -> str:
+    # "success" once the scope is gone, failed scopes stay loaded until reset
+    result = run_systemctl_user("show", "--property=Result", "--value", f"{unit}.scope")
+    run_systemctl_user("reset-failed", f"{unit}.scope")
+    return result
+
+
+def kill_build(proc: subprocess.Popen, unit: str | None):
+    if unit:
+        run_systemctl_user("kill", "--signal=SIGKILL", f"{unit}.scope")
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def list_deb_contents(deb: pathlib.Path) -> list[str]:
+    proc = subprocess.run(["dpkg-deb", "--contents", str(deb)], stdout=subprocess.PIPE, check=True)
+    files = []
+    for line in proc.stdout.decode(errors="replace").splitlines():
+        if m := re.search(r"[0-9]:[0-9][0-9] \./(.*)$", line):
+            files.append(m.group(1))
+    return files
+
+
+def discard_debs(build_dir: pathlib.Path, stem: str) -> dict:
+    # keep .buildinfo, .changes and a manifest of what the .debs contained
+    changes_file = build_dir / f"{stem}.changes"
+    if not changes_file.exists():
+        return {}
+    with changes_file.open("r") as fp:
+        changes = deb822.Changes(fp)
+
+    manifest = {}
+    discarded_bytes = 0
+    unreadable = []
+    for file_meta in changes["Files"]:
+        if not file_meta["name"].endswith((".deb", ".udeb", ".ddeb")):
+            continue
+        deb = build_dir / file_meta["name"]
+        if not deb.exists():
+            continue
+        try:
+            manifest[file_meta["name"].split("_")[0]] = list_deb_contents(deb)
+        except subprocess.CalledProcessError as exc:
+            # keep the .deb to look at, the rest of the run goes on
+            print("Cannot list", deb, exc)
+            unreadable.append(file_meta["name"])
+            continue
+        discarded_bytes += deb.stat().st_size
+        deb.unlink()
+
+    manifest_file = build_dir / f"{stem}.manifest.json.gz"
+    with gzip.open(manifest_file, "wt") as fp:
+        json.dump(manifest, fp, sort_keys=True)
+    result = {"manifest": manifest_file.name, "discarded_bytes": discarded_bytes}
+    if unreadable:
+        result["unreadable_debs"] = unreadable
+    return result
+
+
+def build_one(
+    srcpkg: str, arch: str, build_dir: pathlib.Path, buildlog_dir: pathlib.Path, extra_pkgs, options: dict
+) -> dict:
     build_dir.cwd()
 
-    print(datetime.datetime.now().isoformat(), "Building", srcpkg, "...", f"(worker={os.getpid()})", flush=True)
+    print(datetime.datetime.now().isoformat(), "Building", srcpkg, arch, "...", f"(worker={os.getpid()})", flush=True)
     args = [
         "sbuild",
         "--dist=unstable",
@@ -188,30 +872,70 @@ def build_one(srcpkg: str, build_dir: pathlib.Path, buildlog_dir: pathlib.Path,
         "--no-run-piuparts",
         "--no-run-lintian",
         f"--build-dir={build_dir}",
+        *get_sbuild_arch_args(arch, options["foreign_arch_mode"]),
         srcpkg,
     ]
+    chroot = None
+    if snapshot := options.get("chroot"):
+        chroot = create_chroot_snapshot(snapshot["name"], arch, snapshot["packages"])
+    if chroot:
+        args.append(f"--chroot={chroot}")
+    ccache_stats_log = None
+    if options.get("ccache"):
+        args.append("--add-depends=ccache")
+        ccache_stats_log = pathlib.Path(options["ccache"]["dir"]) / "stats" / f"{get_build_file_stem(srcpkg, arch)}.log"
+        ccache_stats_log.unlink(missing_ok=True)
     for extra_pkg in extra_pkgs:
         args.append(f"--extra-package={extra_pkg}")
 
+    unit = re.sub(r"[^A-Za-z0-9:_.-]", "_", f"demar-build-{get_build_file_stem(srcpkg, arch)}-{os.getpid()}")
+    limit_args = get_resource_limit_args(unit, options.get("memory_max"))
+
     buildlog_file = buildlog_dir / srcpkg
     new_buildlog_file = buildlog_file.with_name(f"{buildlog_file.name}.new")
+    timed_out = False
     with new_buildlog_file.open("w") as out_fp:
-        proc = subprocess.run(
-            args,
+        proc = subprocess.Popen(
+            [*limit_args, *args],
             stdout=out_fp,
             stderr=subprocess.PIPE,
-            env=_create_subprocess_env_block(),
+            env=_create_subprocess_env_block(options.get("ccache"), ccache_stats_log),
+            start_new_session=True,
         )
+        try:
+            _, stderr = proc.communicate(timeout=options.get("timeout"))
+        except subprocess.TimeoutExpired:
+            timed_out = True
+            kill_build(proc, unit if limit_args else None)
+            _, stderr = proc.communicate()
+
+    scope_result = get_scope_result(unit) if limit_args else None
 
     result = {"status": "unknown"}
-    if proc.returncode != 0:
+    if chroot:
+        result["chroot"] = chroot
+    if timed_out:
+        result["status"] = "build_timeout"
+        result["detail"] = {"timeout": options["timeout"]}
+        print("FAIL", srcpkg, arch, f"(killed after {options['timeout']}s)")
+    elif scope_result == "oom-kill":
+        result["status"] = "build_oom"
+        result["detail"] = {"memory_max": options["memory_max"]}
+        print("FAIL", srcpkg, arch, f"(killed for exceeding {options['memory_max']} of memory)")
+    elif proc.returncode != 0:
         result["status"] = "sbuild_failed"
         result["detail"] = {"returncode": proc.returncode}
-        result["stderr"] = proc.stderr.decode().strip()
-        print("FAIL", srcpkg, f"(sbuild exited with {proc.returncode})", proc.stderr.decode().strip())
+        result["stderr"] = stderr.decode().strip()
+        print("FAIL", srcpkg, arch, f"(sbuild exited with {proc.returncode})", stderr.decode().strip())
     else:
         result["status"] = "built"
 
+    if ccache_stats_log:
+        result["ccache"] = read_ccache_stats_log(ccache_stats_log)
+
+    if options.get("metadata_only"):
+        result |= discard_debs(build_dir, get_build_file_stem(srcpkg, arch))
+
     if buildlog_file.exists():
         buildlog_file.replace(buildlog_file.with_name(f"{buildlog_file.name}.old"))
     new_buildlog_file.replace(buildlog_file)
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+import argparse
+import concurrent.futures
+import hashlib
+import json
+import os
+import pathlib
+
+import archive
+
+CACHE_DIR = pathlib.Path("~/.cache/demar").expanduser()
+HASH_CACHE = CACHE_DIR / "mirror-hashes.json"
+
+ARCHS = ["amd64", "arm64", "all"]
+INDEX_FILES = {
+    "binary": ["Packages.xz", "Packages.gz"],
+    "source": ["Sources.xz", "Sources.gz"],
+}
+
+
+def index_files() -> list[pathlib.Path]:
+    dist_dir = pathlib.Path(archive.MIRROR) / "dists" / archive.DIST
+    files = []
+    for component in archive.COMPONENTS:
+        for arch in ARCHS:
+            files += [dist_dir / component / f"binary-{arch}" / name for name in INDEX_FILES["binary"]]
+        files += [dist_dir / component / "source" / name for name in INDEX_FILES["source"]]
+    return files
+
+
+def stat_key(st: os.stat_result) -> list[int]:
+    return [st.st_ino, st.st_size, st.st_mtime_ns]
+
+
+def read_hash_cache() -> dict[str, dict]:
+    if not HASH_CACHE.exists():
+        return {}
+    with HASH_CACHE.open("r") as fp:
+        return json.load(fp)
+
+
+def write_hash_cache(cache: dict[str, dict]):
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    new_file = HASH_CACHE.with_name(f"{HASH_CACHE.name}.new")
+    with new_file.open("w") as fp:
+        json.dump(cache, fp, indent=1, sort_keys=True)
+    new_file.replace(HASH_CACHE)
+
+
+def sha256_file(path: pathlib.Path) -> str:
+    with path.open("rb") as fp:
+        return hashlib.file_digest(fp, "sha256").hexdigest()
+
+
+def cached_hash(path: pathlib.Path, cache: dict[str, dict] | None = None) -> str | None:
+    # only a stat, the file itself is not read
+    if cache is None:
+        cache = read_hash_cache()
+    entry = cache.get(str(path))
+    try:
+        if entry is None or entry["stat"] != stat_key(path.stat()):
+            return None
+    except FileNotFoundError:
+        return None
+    return entry["sha256"]
+
+
+def update_hashes(files: list[pathlib.Path], cache: dict[str, dict], jobs: int) -> dict[str, str]:
+    hashes = {}
+    changed = {}
+    for path in files:
+        try:
+            st = path.stat()
+        except FileNotFoundError:
+            cache.pop(str(path), None)
+            continue
+        entry = cache.get(str(path))
+        if entry and entry["stat"] == stat_key(st):
+            hashes[str(path)] = entry["sha256"]
+        else:
+            changed[path] = stat_key(st)
+
+    print("Hashing", len(changed), "changed of", len(changed) + len(hashes), "index files")
+    # hashlib drops the GIL while hashing, so threads are enough
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        for path, sha256 in zip(changed.keys(), executor.map(sha256_file, changed.keys())):
+            cache[str(path)] = {"stat": changed[path], "sha256": sha256}
+            hashes[str(path)] = sha256
+
+    return hashes
+
+
+def update_by_hash_link(path: pathlib.Path, sha256: str):
+    by_hash_dir = path.parent / "by-hash" / "SHA256"
+    by_hash_dir.mkdir(parents=True, exist_ok=True)
+    link = by_hash_dir / sha256
+    target = os.path.relpath(path, by_hash_dir)
+    if link.is_symlink() and os.readlink(link) == target:
+        return
+    new_link = by_hash_dir / f".{sha256}.new"
+    new_link.unlink(missing_ok=True)
+    new_link.symlink_to(target)
+    new_link.replace(link)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Update by-hash links of the local mirror")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count())
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    cache = read_hash_cache()
+    hashes = update_hashes(index_files(), cache, args.jobs)
+    for path, sha256 in hashes.items():
+        update_by_hash_link(pathlib.Path(path), sha256)
+    write_hash_cache(cache)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+import argparse
+import bisect
+import gzip
+import json
+import pathlib
+import re
+import sys
+
+import numpy as np
+
+import archive
+
+TABLE_DIR = pathlib.Path("~/.cache/demar/path-table").expanduser()
+ARCHS = ["all", "arm64", "amd64"]
+
+# paths.npy holds all paths newline-terminated and sorted, path i spans
+# paths[path_offsets[i]:path_offsets[i + 1] - 1]; the packages shipping it are
+# packages[owner_ids[owner_offsets[i]:owner_offsets[i + 1]]]
+ARRAYS = ["paths", "path_offsets", "owner_offsets", "owner_ids", "packages"]
+
+
+def contents_files() -> list[pathlib.Path]:
+    return [archive.contents_file(component, arch) for component in archive.COMPONENTS for arch in ARCHS]
+
+
+def stat_keys(files: list[pathlib.Path]) -> dict[str, list[int]]:
+    keys = {}
+    for file in files:
+        st = file.stat()
+        keys[str(file)] = [st.st_ino, st.st_size, st.st_mtime_ns]
+    return keys
+
+
+def build(table_dir: pathlib.Path, files: list[pathlib.Path]):
+    package_ids: dict[str, int] = {}
+    owners: dict[bytes, set[int]] = {}
+    for file in files:
+        print("Reading contents", file)
+        with gzip.open(file, "rb") as fp:
+            for line in fp:
+                path, packages = line.rstrip(b"\n").rsplit(maxsplit=1)
+                ids = owners.setdefault(path, set())
+                for package in packages.decode().split(","):
+                    name = package.rsplit("/", 1)[1]
+                    ids.add(package_ids.setdefault(name, len(package_ids)))
+
+    paths = sorted(owners.keys())
+    path_lengths = np.fromiter((len(path) + 1 for path in paths), dtype=np.int64, count=len(paths))
+    path_offsets = np.zeros(len(paths) + 1, dtype=np.int64)
+    np.cumsum(path_lengths, out=path_offsets[1:])
+
+    owner_counts = np.fromiter((len(owners[path]) for path in paths), dtype=np.int64, count=len(paths))
+    owner_offsets = np.zeros(len(paths) + 1, dtype=np.int64)
+    np.cumsum(owner_counts, out=owner_offsets[1:])
+    owner_ids = np.fromiter(
+        (i for path in paths for i in sorted(owners[path])), dtype=np.int32, count=int(owner_offsets[-1])
+    )
+
+    arrays = {
+        "paths": np.frombuffer(b"".join(path + b"\n" for path in paths), dtype=np.uint8),
+        "path_offsets": path_offsets,
+        "owner_offsets": owner_offsets,
+        "owner_ids": owner_ids,
+        "packages": np.array(list(package_ids.keys()), dtype=np.bytes_),
+    }
+
+    table_dir.mkdir(parents=True, exist_ok=True)
+    for name, array in arrays.items():
+        new_file = table_dir / f"{name}.new.npy"
+        np.save(new_file, array)
+        new_file.replace(table_dir / f"{name}.npy")
+    with (table_dir / "meta.json").open("w") as fp:
+        json.dump({"sources": stat_keys(files), "paths": len(paths), "packages": len(package_ids)}, fp)
+    print("Wrote", len(paths), "paths of", len(package_ids), "packages to", table_dir)
+
+
+def is_stale(table_dir: pathlib.Path, files: list[pathlib.Path]) -> bool:
+    meta_file = table_dir / "meta.json"
+    if not meta_file.exists():
+        return True
+    with meta_file.open("r") as fp:
+        return json.load(fp)["sources"] != stat_keys(files)
+
+
+class PathTable:
+    def __init__(self, table_dir: pathlib.Path):
+        for name in ARRAYS:
+            setattr(self, name, np.load(table_dir / f"{name}.npy", mmap_mode="r"))
+
+    def __len__(self) -> int:
+        return len(self.path_offsets) - 1
+
+    def __getitem__(self, i: int) -> bytes:
+        # lets bisect search the table like a sorted list of paths
+        return self.paths[self.path_offsets[i] : self.path_offsets[i + 1] - 1].tobytes()
+
+    def prefix_range(self, prefix: str) -> tuple[int, int]:
+        prefix = prefix.encode()
+        return bisect.bisect_left(self, prefix), bisect.bisect_left(self, prefix + b"\xff")
+
+    def find_prefixes(self, prefixes: tuple[str, ...]) -> np.ndarray:
+        # merge overlapping ranges, which keeps the result sorted and unique
+        merged = []
+        for lo, hi in sorted(self.prefix_range(prefix) for prefix in prefixes):
+            if merged and lo <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], hi)
+            else:
+                merged.append([lo, hi])
+        return np.concatenate([np.arange(lo, hi, dtype=np.int64) for lo, hi in merged] or [np.array([], np.int64)])
+
+    def find_regex(self, pattern: str) -> np.ndarray:
+        # match line by line over the whole blob, then map match offsets to path ids
+        regex = re.compile(rb"^[^\n]*?(?:" + pattern.encode() + rb")", re.MULTILINE)
+        starts = np.fromiter((m.start() for m in regex.finditer(memoryview(self.paths))), dtype=np.int64)
+        return np.unique(np.searchsorted(self.path_offsets, starts, side="right") - 1)
+
+    def path_strings(self, ids: np.ndarray) -> list[str]:
+        return [self[i].decode() for i in ids]
+
+    def owners(self, ids: np.ndarray) -> set[str]:
+        ids = np.asarray(ids, dtype=np.int64)
+        starts = self.owner_offsets[ids]
+        counts = self.owner_offsets[ids + 1] - starts
+        # concatenated owner_ids[starts[k]:starts[k] + counts[k]] for all k
+        index = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        owned = np.zeros(len(self.packages), dtype=bool)
+        owned[self.owner_ids[index]] = True
+        return {name.decode() for name in self.packages[owned]}
+
+
+def open_table(table_dir: pathlib.Path = TABLE_DIR) -> PathTable:
+    files = contents_files()
+    if is_stale(table_dir, files):
+        build(table_dir, files)
+    return PathTable(table_dir)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Build and query the columnar Contents path table")
+    parser.add_argument("--table-dir", dest="table_dir", type=pathlib.Path, default=TABLE_DIR)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build_parser = subparsers.add_parser("build")
+    build_parser.add_argument("--force", default=False, action="store_true")
+    query_parser = subparsers.add_parser("query")
+    query_parser.add_argument("--prefix", dest="prefixes", action="append", default=[])
+    query_parser.add_argument("--regex")
+    query_parser.add_argument("--paths", default=False, action="store_true")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    if args.command == "build":
+        files = contents_files()
+        if args.force or is_stale(args.table_dir, files):
+            build(args.table_dir, files)
+        return
+
+    table = open_table(args.table_dir)
+    if args.regex:
+        ids = table.find_regex(args.regex)
+        if args.prefixes:
+            ids = np.intersect1d(ids, table.find_prefixes(tuple(args.prefixes)))
+    elif args.prefixes:
+        ids = table.find_prefixes(tuple(args.prefixes))
+    else:
+        print("E: need --prefix or --regex", file=sys.stderr)
+        sys.exit(1)
+
+    if args.paths:
+        print("\n".join(table.path_strings(ids)))
+    else:
+        print("\n".join(sorted(table.owners(ids))))
+
+
+if __name__ == "__main__":
+    main()
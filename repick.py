@@ -0,0 +1,69 @@
+import json
+import pathlib
+import time
+
+import archive
+
+CACHE_DIR = pathlib.Path("~/.cache/demar").expanduser()
+
+# each term is added to a candidate's score, higher scores are rebuilt first
+SCORE_PER_CHANGED_BUILD_DEP = 1.0
+MAX_BUILD_DEP_SCORE = 20.0
+SCORE_OLD_FTBFS_WITHOUT_BUG = 5.0
+SCORE_OPEN_FTBFS_BUG = -10.0
+SCORE_PER_DAY_OLD = 0.1
+
+
+def read_bugs_cache(selector: str) -> list[dict]:
+    # unlike tally_results, an outdated cache is still good enough to rank with
+    cache_file = CACHE_DIR / f"bugs-{selector}"
+    if not cache_file.exists():
+        print("Bugs cache", cache_file, "is missing, not using it for repicking")
+        return []
+    with cache_file.open("rb") as fp:
+        return json.load(fp)
+
+
+def get_open_ftbfs_sources() -> set[str]:
+    return {bug["source"] for bug in read_bugs_cache("ftbfs")}
+
+
+class RepickScorer:
+    def __init__(self, current_versions: dict[str, dict[str, str] | None]):
+        self.now = time.time()
+        self.open_ftbfs = get_open_ftbfs_sources()
+        self.current_versions = current_versions
+
+    def score(self, srcpkg: str, arch: str, status: dict) -> tuple[float, dict]:
+        srcpkg_name = srcpkg.split("_")[0]
+        last_attempt = status.get("last_attempt", self.now)
+        reasons = {}
+
+        if installed := status.get("build_depends"):
+            current_versions = self.current_versions.get(arch)
+            if current_versions is not None:
+                changed = archive.changed_build_depends(installed, current_versions)
+                if changed:
+                    reasons["build_deps_changed"] = min(len(changed) * SCORE_PER_CHANGED_BUILD_DEP, MAX_BUILD_DEP_SCORE)
+
+        if srcpkg_name in self.open_ftbfs:
+            reasons["open_ftbfs_bug"] = SCORE_OPEN_FTBFS_BUG
+        elif status["status"] == "old_ftbfs":
+            reasons["old_ftbfs_without_bug"] = SCORE_OLD_FTBFS_WITHOUT_BUG
+
+        reasons["age"] = (self.now - last_attempt) / 86400 * SCORE_PER_DAY_OLD
+
+        return sum(reasons.values()), reasons
+
+
+def rank_repick_candidates(
+    candidates: list[tuple[str, str, dict]], current_versions: dict[str, dict[str, str] | None]
+) -> list[tuple[float, str, str, dict]]:
+    scorer = RepickScorer(current_versions)
+    ranked = []
+    for srcpkg, arch, status in candidates:
+        score, reasons = scorer.score(srcpkg, arch, status)
+        ranked.append((score, srcpkg, arch, reasons))
+    # sort is stable, so candidates with equal scores keep their incoming order
+    ranked.sort(key=lambda r: r[0], reverse=True)
+    return ranked
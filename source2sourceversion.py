@@ -7,6 +7,8 @@ import sys
 from debian import deb822
 from debian.debian_support import version_compare
 
+import index_server
+
 ARCHS = ["all", "arm64", "amd64"]
 COMPONENTS = ["main", "contrib", "non-free", "non-free-firmware"]
 
@@ -14,16 +16,12 @@ COMPONENTS = ["main", "contrib", "non-free", "non-free-firmware"]
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser()
     parser.add_argument("filename", type=argparse.FileType(mode="r"))
+    parser.add_argument("--server", default=False, action="store_true")
     return parser.parse_args()
 
 
-def main():
-    mirror = "/srv/debian-mirror/mirror"
+def read_source_versions(mirror: str, unversioned_srcs: set[str]) -> dict[str, str]:
     source_pkg_versions = {}
-
-    args = parse_args()
-    unversioned_srcs = set([line.strip() for line in args.filename.read().strip().splitlines() if line])
-
     for component in COMPONENTS:
         for arch in ARCHS:
             pkglist_file = pathlib.Path(f"{mirror}/dists/sid/{component}/binary-{arch}/Packages.gz")
@@ -37,6 +35,23 @@ def main():
                     if other_ver and version_compare(other_ver, source_version) >= 0:
                         continue
                     source_pkg_versions[source_name] = source_version
+    return source_pkg_versions
+
+
+def main():
+    mirror = "/srv/debian-mirror/mirror"
+
+    args = parse_args()
+    unversioned_srcs = set([line.strip() for line in args.filename.read().strip().splitlines() if line])
+
+    source_pkg_versions = None
+    if args.server:
+        try:
+            source_pkg_versions = index_server.query("source_versions", sorted(unversioned_srcs))
+        except OSError as exc:
+            print("Index server unreachable, reading Packages instead:", exc, file=sys.stderr)
+    if source_pkg_versions is None:
+        source_pkg_versions = read_source_versions(mirror, unversioned_srcs)
 
     source_pkgs = set()
     for source_name, source_version in source_pkg_versions.items():
@@ -3,11 +3,14 @@ import argparse
 import datetime
 import json
 import re
+import sqlite3
 import time
 from pathlib import Path
 
 import yaml
 
+import archive
+
 CACHE_DIR = Path("~/.cache/demar").expanduser()
 
 META = {
@@ -98,6 +101,17 @@ DEBOOTSTRAP_VARIANT_ESSENTIAL = {
 }
 PSEUDO_ESSENTIAL = DEBOOTSTRAP_VARIANT_ESSENTIAL - ESSENTIAL - ONE_UPLOAD
 
+PREDICT_ARCH = "amd64"
+DEBOOTSTRAP_ARCH = "amd64"
+MAX_PREDICTED_FILES = 1000
+
+# predicted groups which need a real rebuild to tell what is going on;
+# Contents lists no symlink targets, so "symlink" is never predicted
+AMBIGUOUS_GROUPS = {"multiple", "UNCATEGORIZED"}
+
+# filled by import_dumat_findings.py from the dumat analyzer output
+DUMAT_FINDINGS_TABLE = "demar_findings"
+
 SOURCES_WITH_ANY_YET_ALL_RELEVANT = {
     "acpi-support",
     "aide",
@@ -125,12 +139,10 @@ SOURCES_WITH_ANY_YET_ALL_RELEVANT = {
 }
 
 
-def read_deboostrap_srcs_file(filename: str):
-    file = Path(__file__).parent / filename
-    print("Reading debootstrap srcs file", file)
-    with file.open("r") as fp:
-        packages = [line.split(" ") for line in fp.read().strip().splitlines()]
-        return {parts[1].strip() for parts in packages if len(parts) > 1}
+def read_deboostrap_srcs_file(arch: str) -> set[str]:
+    # computed from the mirror's Packages files, cached until they change
+    print("Reading debootstrap srcs for", arch)
+    return archive.get_debootstrap_sources(arch)
 
 
 def read_binarycontrol_file(filename: str) -> set[str]:
@@ -139,12 +151,21 @@ def read_binarycontrol_file(filename: str) -> set[str]:
         return json.load(fp)
 
 
-def read_skip_file(filename: str):
+def read_skip_file(filename: str, fail_file: str | None = None):
     file = Path(__file__).parent / filename
     print("Reading skip file", file)
     with file.open("r") as fp:
         skip_reasons = [line.split("#", 1) for line in fp.read().strip().splitlines()]
-        return {k.strip(): v.strip() for (k, v) in skip_reasons}
+        skip_reasons = {k.strip(): v.strip() for (k, v) in skip_reasons}
+    if fail_file:
+        skip_reasons |= read_fail_file(fail_file)
+    return skip_reasons
+
+
+def read_fail_file(filename: str) -> dict[str, str]:
+    # maintained by massrebuild
+    print("Reading fail file", filename)
+    return archive.fail_skip_reasons(archive.read_fail_file(Path(filename)))
 
 
 def read_bugs_cache(selector: str):
@@ -158,6 +179,27 @@ def read_bugs_cache(selector: str):
         return json.load(fp)
 
 
+def open_dumat_db(filename: str) -> sqlite3.Connection | None:
+    file = Path(filename).absolute()
+    if not file.exists():
+        print("Dumat db", file, "is missing, not using dumat findings")
+        return None
+    conn = sqlite3.connect(f"file:{file}?mode=ro", uri=True)
+    # only there once update-dumat-db ran import_dumat_findings.py
+    query = "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?"
+    if conn.execute(query, (DUMAT_FINDINGS_TABLE,)).fetchone() is None:
+        print("Dumat db", file, "has no findings imported yet, not using dumat findings")
+        conn.close()
+        return None
+    print("Using dumat db", file)
+    return conn
+
+
+def get_dumat_findings(conn: sqlite3.Connection, src: str) -> list[dict]:
+    cursor = conn.execute(f"SELECT finding FROM {DUMAT_FINDINGS_TABLE} WHERE source = ? ORDER BY rowid", (src,))
+    return [json.loads(row[0]) for row in cursor]
+
+
 def get_dep17_bugs() -> tuple[dict[str, dict], dict[str, list[dict]]]:
     bugs = {}
     pkg_meta = {}
@@ -199,8 +241,8 @@ def get_ftbfs_bugs() -> dict[str, list[dict]]:
     return bugs
 
 
-def get_build_results(rebuild_list: str, buildlogs_dir: str) -> list[dict]:
-    skip_reasons = read_skip_file("skip_reasons")
+def get_build_results(rebuild_list: str, buildlogs_dir: str, fail_file: str | None = None) -> list[dict]:
+    skip_reasons = read_skip_file("skip_reasons", fail_file)
     ftbfs_bugs = get_ftbfs_bugs()
 
     with Path(rebuild_list).open("r") as fp:
@@ -314,14 +356,143 @@ def get_build_results(rebuild_list: str, buildlogs_dir: str) -> list[dict]:
     return results
 
 
+def categorize_files(files: list[str]) -> set[str]:
+    groups = set()
+    if not files:
+        return groups
+
+    for file in files:
+        if " -> " in file or " link to " in file:
+            groups.add("symlink")
+
+        if file.startswith("lib/debian-installer"):
+            groups.add("d-i")
+
+        if file.startswith("lib/security") or file.startswith("lib/x86_64-linux-gnu/security"):
+            groups.add("pam")
+            continue
+
+        if file.startswith("lib/firmware"):
+            groups.add("firmware")
+            continue
+
+        if file.startswith("lib/udev"):
+            groups.add("udev")
+            continue
+
+        if file.startswith("lib/systemd"):
+            groups.add("systemd")
+            continue
+
+        if file.startswith("bin/") and file[-1] != "/":
+            groups.add("bin")
+            continue
+
+        if file.startswith("sbin/") and file[-1] != "/":
+            groups.add("sbin")
+            continue
+
+        if file.startswith("lib/") and file[-1] != "/":
+            groups.add("lib-other")
+            continue
+
+    # done with exclusives
+
+    if all(file.endswith("/") for file in files):
+        groups.add("empty-dirs")
+
+    if len(groups) > 1:
+        groups.add("multiple")
+
+    if all(file.startswith("bin/") for file in files):
+        groups.add("just-bin")
+    if all(file.startswith("sbin/") for file in files):
+        groups.add("just-sbin")
+
+    if len(groups) == 0:
+        groups.add("UNCATEGORIZED")
+
+    return groups
+
+
+def predict_files_from_contents(srcs: set[str]) -> dict[str, list[str]]:
+    print("Reading binary to source mapping for", PREDICT_ARCH)
+    bin_sources = archive.read_binary_sources(PREDICT_ARCH)
+
+    predicted = {}
+    for component in archive.COMPONENTS:
+        for arch in (PREDICT_ARCH, "all"):
+            contents = archive.contents_file(component, arch)
+            print("Reading contents", contents)
+            for path, bin_pkgs in archive.iter_contents(contents):
+                # same filter as for the package contents in buildlogs
+                if path[0:3] in ("", "usr", "etc", "var", "boot"):
+                    continue
+                for src in {bin_sources.get(bin_pkg) for bin_pkg in bin_pkgs}:
+                    if src not in srcs:
+                        continue
+                    files = predicted.setdefault(src, set())
+                    if len(files) < MAX_PREDICTED_FILES:
+                        files.add(path)
+                    else:
+                        files.add("MORE_THAN_1000")
+
+    return {src: list(sorted(list(files))) for src, files in predicted.items()}
+
+
+def shard_file(output_dir: Path, src: str) -> Path:
+    # same layout as the archive pool, keeps directories small
+    prefix = src[0:4] if src.startswith("lib") else src[0]
+    return output_dir / "sources" / prefix / f"{src}.yaml"
+
+
+def write_if_changed(file: Path, content: str) -> bool:
+    if file.exists() and file.read_text() == content:
+        return False
+    file.parent.mkdir(parents=True, exist_ok=True)
+    new_file = file.with_name(f"{file.name}.new")
+    new_file.write_text(content)
+    new_file.replace(file)
+    return True
+
+
+def write_sharded_output(output_dir: Path, index: dict, lists: dict[str, dict[str, dict]]):
+    # one file per source, so a run only touches the sources which changed
+    wanted = set()
+    written = 0
+    for list_name, pkgs in lists.items():
+        for src, pkg_todo in pkgs.items():
+            file = shard_file(output_dir, src)
+            wanted.add(file)
+            bugs = sorted(pkg_todo["bugs"], key=lambda bug: bug["id"])
+            written += write_if_changed(file, yaml.safe_dump({"list": list_name} | pkg_todo | {"bugs": bugs}))
+
+    removed = 0
+    for file in (output_dir / "sources").glob("*/*.yaml"):
+        if file not in wanted:
+            file.unlink()
+            removed += 1
+
+    write_if_changed(output_dir / "index.yaml", yaml.safe_dump(index))
+    print("Wrote", written, "changed and removed", removed, "of", len(wanted), "source files in", output_dir)
+
+
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(description="tally build results against open bugs")
-    parser.add_argument("-o", dest="output", required=True)
+    parser.add_argument("-o", dest="output")
+    parser.add_argument("--output-dir", dest="output_dir", type=Path)
     parser.add_argument("--buildlogs-dir", dest="buildlogs_dir", required=True)
     parser.add_argument("--rebuild-list", dest="rebuild_list", required=True)
+    parser.add_argument("--fail-file", dest="fail_file")
     parser.add_argument("--output-need-rebuild", dest="output_need_rebuild")
     parser.add_argument("--output-bootstrap", dest="output_bootstrap")
-    return parser.parse_args()
+    parser.add_argument("--predict-from-contents", dest="predict_from_contents", default=False, action="store_true")
+    parser.add_argument("--output-predicted", dest="output_predicted")
+    parser.add_argument("--dumat-db", dest="dumat_db")
+    args = parser.parse_args()
+    if not args.output and not args.output_dir:
+        parser.error("one of -o and --output-dir is required")
+    return args
 
 
 def main():
@@ -337,77 +508,41 @@ def main():
     pkg_meta, bugs = get_dep17_bugs()
     print("Reading build logs")
 
-    # dpkg --root unstable -l > demar/debootstrap-standard
-    # (for x in $( awk '/^ii /{  print $2 }' demar/debootstrap-standard ); do
-    #    chdist unstable apt-cache show $x  | egrep '(Source|Package):';
-    # done | sort | uniq ) > demar/debootstrap-standard-srcs
-    debootstrap_variant_standard = read_deboostrap_srcs_file("debootstrap-standard-srcs")
+    debootstrap_variant_standard = read_deboostrap_srcs_file(DEBOOTSTRAP_ARCH)
 
     bins_using_statoverride = read_binarycontrol_file("binaries-using-statoverride")
 
+    dumat_db = open_dumat_db(args.dumat_db) if args.dumat_db else None
+
     stats = {"total_packages": 0, "groups": {}, "guessed_status": {}}
 
-    for build_result in get_build_results(args.rebuild_list, args.buildlogs_dir):
+    build_results = get_build_results(args.rebuild_list, args.buildlogs_dir, args.fail_file)
+    predicted = {}
+    if args.predict_from_contents:
+        unbuilt = {r["source"]: r for r in build_results if r.get("build_problem") == "no-build-result-found"}
+        for src, files in predict_files_from_contents(set(unbuilt.keys())).items():
+            unbuilt[src]["predicted_files"] = files
+
+    for build_result in build_results:
         src = build_result["source"]
         print("Categorizing", src)
         pkg_todo = pkg_meta.get(src, {})
         pkg_todo["bugs"] = bugs.get(src, [])
+        if dumat_db is not None:
+            if dumat_findings := get_dumat_findings(dumat_db, src):
+                pkg_todo["dumat"] = dumat_findings
         del build_result["source"]
         just_need_rebuild = False
 
-        groups = set()
-
-        if build_result["files"]:
-            for file in build_result["files"]:
-                if " -> " in file or " link to " in file:
-                    groups.add("symlink")
-
-                if file.startswith("lib/debian-installer"):
-                    groups.add("d-i")
-
-                if file.startswith("lib/security") or file.startswith("lib/x86_64-linux-gnu/security"):
-                    groups.add("pam")
-                    continue
-
-                if file.startswith("lib/firmware"):
-                    groups.add("firmware")
-                    continue
-
-                if file.startswith("lib/udev"):
-                    groups.add("udev")
-                    continue
-
-                if file.startswith("lib/systemd"):
-                    groups.add("systemd")
-                    continue
-
-                if file.startswith("bin/") and file[-1] != "/":
-                    groups.add("bin")
-                    continue
-
-                if file.startswith("sbin/") and file[-1] != "/":
-                    groups.add("sbin")
-                    continue
-
-                if file.startswith("lib/") and file[-1] != "/":
-                    groups.add("lib-other")
-                    continue
-
-            # done with exclusives
-
-            if all(file.endswith("/") for file in build_result["files"]):
-                groups.add("empty-dirs")
-
-            if len(groups) > 1:
-                groups.add("multiple")
-
-            if all(file.startswith("bin/") for file in build_result["files"]):
-                groups.add("just-bin")
-            if all(file.startswith("sbin/") for file in build_result["files"]):
-                groups.add("just-sbin")
-
-            if len(groups) == 0:
-                groups.add("UNCATEGORIZED")
+        groups = categorize_files(build_result["files"])
+        # only the groups are kept, the path list would bloat the published tally
+        if predicted_files := build_result.pop("predicted_files", None):
+            groups = categorize_files(predicted_files) | {"predicted"}
+            predicted[src] = {
+                "version": build_result["version"],
+                "groups": list(sorted(list(groups))),
+                "ambiguous": bool(groups & AMBIGUOUS_GROUPS),
+            }
 
         if any(bin_pkg in bins_using_statoverride for bin_pkg in build_result["bin_pkgs"]):
             groups.add("dpkg-statoverride")
@@ -443,6 +578,9 @@ def main():
 
             guessed_status = "bug-filed"
 
+        if guessed_status is None and pkg_todo.get("dumat"):
+            guessed_status = "dumat-finding"
+
         if (
             guessed_status is None
             and build_result["built"] is not None
@@ -497,8 +635,14 @@ def main():
         "rebuild_timestamp": datetime.datetime.fromtimestamp(Path(args.rebuild_list).stat().st_mtime).isoformat(),
     } | META
 
-    with Path(args.output).open("w") as fp:
-        yaml.safe_dump_all([{"___meta": meta}, {"___stats": stats}, work_todo], fp)
+    if args.output:
+        with Path(args.output).open("w") as fp:
+            yaml.safe_dump_all([{"___meta": meta}, {"___stats": stats}, work_todo], fp)
+
+    if args.output_dir:
+        write_sharded_output(
+            args.output_dir, {"___meta": meta, "___stats": stats}, {"todo": work_todo, "need-rebuild": need_rebuild}
+        )
 
     if args.output_need_rebuild:
         with Path(args.output_need_rebuild).open("w") as fp:
@@ -508,6 +652,10 @@ def main():
         with Path(args.output_bootstrap).open("w") as fp:
             yaml.safe_dump_all([bootstrap], fp)
 
+    if args.output_predicted:
+        with Path(args.output_predicted).open("w") as fp:
+            yaml.safe_dump(predicted, fp)
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,128 @@
+import contextlib
+import json
+import pathlib
+import sqlite3
+import time
+
+LEASE_DURATION = 10 * 60  # seconds a claim stays valid without a heartbeat
+HEARTBEAT_INTERVAL = 60
+MAX_ATTEMPTS = 3  # claims before an item is given up, e.g. when it keeps killing its worker
+
+QUEUE_FILE = "queue.sqlite"
+
+
+class WorkQueue:
+    def __init__(self, queue_file: pathlib.Path):
+        # no WAL, its shared memory index does not work for a job dir on a network filesystem
+        self.conn = sqlite3.connect(queue_file, timeout=60, isolation_level=None)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS items (
+                srcpkg TEXT NOT NULL,
+                arch TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                state TEXT NOT NULL,
+                enqueued REAL NOT NULL,
+                position INTEGER NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                worker TEXT,
+                lease_expires REAL,
+                result TEXT,
+                PRIMARY KEY (srcpkg, arch)
+            )""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS items_state ON items (state, arch)")
+
+    def close(self):
+        self.conn.close()
+
+    def enqueue(self, items: list[tuple[str, str, dict]]):
+        # items being built right now are left alone, finished ones are queued again
+        now = time.time()
+        planned = {(srcpkg, arch) for srcpkg, arch, _ in items}
+        with self.transaction():
+            # whatever an earlier, interrupted plan left unbuilt is superseded
+            stale = self.conn.execute(
+                """SELECT srcpkg, arch FROM items
+                WHERE state = 'queued' OR (state = 'claimed' AND lease_expires < ?)""",
+                (now,),
+            ).fetchall()
+            self.conn.executemany(
+                "DELETE FROM items WHERE srcpkg = ? AND arch = ?", [key for key in stale if key not in planned]
+            )
+            self.conn.executemany(
+                """INSERT INTO items (srcpkg, arch, payload, state, enqueued, position)
+                VALUES (?, ?, ?, 'queued', ?, ?)
+                ON CONFLICT (srcpkg, arch) DO UPDATE SET
+                    payload = excluded.payload,
+                    state = 'queued',
+                    enqueued = excluded.enqueued,
+                    position = excluded.position,
+                    attempts = 0,
+                    worker = NULL,
+                    lease_expires = NULL
+                WHERE state != 'claimed'""",
+                [(srcpkg, arch, json.dumps(payload), now, i) for i, (srcpkg, arch, payload) in enumerate(items)],
+            )
+
+    def claim(self, worker: str, archs: list[str]) -> tuple[str, str, dict] | None:
+        now = time.time()
+        with self.transaction():
+            row = self.conn.execute(
+                f"""SELECT srcpkg, arch, payload FROM items
+                WHERE arch IN ({", ".join("?" * len(archs))})
+                AND (state = 'queued' OR (state = 'claimed' AND lease_expires < ?))
+                AND attempts < ?
+                ORDER BY enqueued, position
+                LIMIT 1""",
+                (*archs, now, MAX_ATTEMPTS),
+            ).fetchone()
+            if row is None:
+                return None
+            srcpkg, arch, payload = row
+            self.conn.execute(
+                """UPDATE items SET state = 'claimed', worker = ?, lease_expires = ?, attempts = attempts + 1
+                WHERE srcpkg = ? AND arch = ?""",
+                (worker, now + LEASE_DURATION, srcpkg, arch),
+            )
+        return srcpkg, arch, json.loads(payload)
+
+    def heartbeat(self, worker: str, items: list[tuple[str, str]]):
+        with self.transaction():
+            self.conn.executemany(
+                """UPDATE items SET lease_expires = ?
+                WHERE srcpkg = ? AND arch = ? AND worker = ? AND state = 'claimed'""",
+                [(time.time() + LEASE_DURATION, srcpkg, arch, worker) for srcpkg, arch in items],
+            )
+
+    def finish(self, worker: str, srcpkg: str, arch: str, result: dict) -> bool:
+        with self.transaction():
+            cursor = self.conn.execute(
+                """UPDATE items SET state = 'done', lease_expires = NULL, result = ?
+                WHERE srcpkg = ? AND arch = ? AND worker = ? AND state = 'claimed'""",
+                (json.dumps(result, default=str), srcpkg, arch, worker),
+            )
+        # False when the lease expired and another worker took the item over
+        return cursor.rowcount == 1
+
+    def pending(self, archs: list[str]) -> list[tuple[str, str]]:
+        # what is left to claim, in claim order
+        return self.conn.execute(
+            f"""SELECT srcpkg, arch FROM items
+            WHERE arch IN ({", ".join("?" * len(archs))})
+            AND (state = 'queued' OR (state = 'claimed' AND lease_expires < ?))
+            AND attempts < ?
+            ORDER BY enqueued, position""",
+            (*archs, time.time(), MAX_ATTEMPTS),
+        ).fetchall()
+
+    def counts(self) -> dict[str, int]:
+        return dict(self.conn.execute("SELECT state, count(*) FROM items GROUP BY state").fetchall())
+
+    @contextlib.contextmanager
+    def transaction(self):
+        # take the write lock up front, so two workers cannot claim the same item
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.conn.execute("COMMIT")